@@ -4,14 +4,25 @@
 
 """Update DB charm module."""
 
+import json
 import logging
+from contextlib import nullcontext
+from functools import partial
 
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus
-
-from db_upgrade import MongoUpgrade, MysqlUpgrade
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+
+from db_upgrade import (
+    ALL_PATCHES,
+    AUTO_MODE,
+    DEFAULT_IN_FLIGHT_WRITES,
+    SYNC_ENGINE,
+    MongoUpgrade,
+    MysqlUpgrade,
+)
+from profiler import profile
 
 logger = logging.getLogger(__name__)
 
@@ -37,7 +48,21 @@ class UpgradeDBCharm(CharmBase):
     def mongo(self):
         """Create MongoUpgrade object if the configuration has been set."""
         mongo_uri = self.config.get("mongodb-uri")
-        return MongoUpgrade(mongo_uri) if mongo_uri else None
+        if not mongo_uri:
+            return None
+        return MongoUpgrade(
+            mongo_uri,
+            batch_size=self.config.get("batch-size"),
+            concurrency=self.config.get("concurrency"),
+            pool_size=self.config.get("pool-size"),
+            compressors=self.config.get("compressors"),
+            read_concern=self.config.get("read-concern"),
+            write_concern=self.config.get("write-concern"),
+            max_write_rate=self.config.get("max-write-rate"),
+            max_write_bytes_rate=self.config.get("max-write-bytes-rate"),
+            max_write_latency=self.config.get("max-write-latency"),
+            write_buffer_size=self.config.get("write-buffer-size") * 1024 * 1024,
+        )
 
     @property
     def mysql(self):
@@ -55,28 +80,54 @@ class UpgradeDBCharm(CharmBase):
 
     def _on_update_db_action(self, event):
         """Handle the update-db action."""
-        current_version = str(event.params["current-version"])
         target_version = str(event.params["target-version"])
         mysql_only = event.params.get("mysql-only")
         mongodb_only = event.params.get("mongodb-only")
+        options = self._mongo_options(event.params)
+        options["progress"] = partial(self._report_progress, event)
+        dry_run = options["dry_run"]
         try:
+            current_version = self._current_version(event.params)
             results = {}
             if mysql_only and mongodb_only:
                 raise Exception("cannot set both mysql-only and mongodb-only options to True")
-            if mysql_only:
-                self._upgrade_mysql(current_version, target_version)
-                results["mysql"] = "Upgraded successfully"
-            elif mongodb_only:
-                self._upgrade_mongodb(current_version, target_version)
-                results["mongodb"] = "Upgraded successfully"
-            else:
-                self._upgrade_mysql(current_version, target_version)
-                results["mysql"] = "Upgraded successfully"
-                self._upgrade_mongodb(current_version, target_version)
-                results["mongodb"] = "Upgraded successfully"
+            if mysql_only and dry_run:
+                raise Exception("dry-run is only supported for mongodb")
+            with self._profile(event, "update-db") as summary:
+                if mysql_only:
+                    self._upgrade_mysql(current_version, target_version)
+                    results["mysql"] = "Upgraded successfully"
+                elif dry_run:
+                    results["mongodb"] = self._upgrade_mongodb(
+                        current_version, target_version, options
+                    )
+                elif mongodb_only:
+                    metrics = self._upgrade_mongodb(current_version, target_version, options)
+                    results["mongodb"] = "Upgraded successfully"
+                    results["mongodb-metrics"] = json.dumps(metrics)
+                else:
+                    self._upgrade_mysql(current_version, target_version)
+                    results["mysql"] = "Upgraded successfully"
+                    metrics = self._upgrade_mongodb(current_version, target_version, options)
+                    results["mongodb"] = "Upgraded successfully"
+                    results["mongodb-metrics"] = json.dumps(metrics)
+            if summary is not None:
+                results["profile"] = json.dumps(summary)
             event.set_results(results)
         except Exception as e:
             event.fail(f"Failed DB Upgrade: {e}")
+        finally:
+            self._on_config_changed(None)
+
+    def _current_version(self, params):
+        """Return the current-version param, or the version recorded in the MongoDB ledger."""
+        if params.get("current-version") is not None:
+            return str(params["current-version"])
+        version = self.mongo.current_version() if self.mongo else None
+        if not version:
+            raise Exception("current-version not set and not found in the migration ledger")
+        logger.info(f"Current version {version} found in the migration ledger")
+        return version
 
     def _upgrade_mysql(self, current_version, target_version):
         logger.debug("Upgrading mysql")
@@ -85,23 +136,89 @@ class UpgradeDBCharm(CharmBase):
         else:
             raise Exception("mysql-uri not set")
 
-    def _upgrade_mongodb(self, current_version, target_version):
+    def _upgrade_mongodb(self, current_version, target_version, options):
         logger.debug("Upgrading mongodb")
         if self.mongo:
-            self.mongo.upgrade(current_version, target_version)
+            return self.mongo.upgrade(current_version, target_version, **options)
         else:
             raise Exception("mongo-uri not set")
 
     def _on_apply_patch_action(self, event):
-        bug_number = event.params["bug-number"]
-        logger.debug("Patching bug number {}".format(str(bug_number)))
+        bug_number = event.params.get("bug-number")
+        bug_numbers = event.params.get("bug-numbers")
+        options = self._mongo_options(event.params)
+        options["progress"] = partial(self._report_progress, event)
         try:
-            if self.mongo:
-                self.mongo.apply_patch(bug_number)
-            else:
+            if not self.mongo:
                 raise Exception("mongo-uri not set")
+            if bug_numbers:
+                bug_numbers = self._parse_bug_numbers(bug_numbers)
+            elif not bug_number:
+                raise Exception("bug-number or bug-numbers must be set")
+            with self._profile(event, "apply-patch") as summary:
+                if bug_numbers:
+                    logger.debug(f"Patching bug numbers {bug_numbers}")
+                    results = self.mongo.apply_patches(bug_numbers, **options)
+                else:
+                    logger.debug("Patching bug number {}".format(str(bug_number)))
+                    results = self.mongo.apply_patch(bug_number, **options)
+            if options["dry_run"]:
+                results = {"mongodb": results}
+            else:
+                results = {
+                    "mongodb": "Patched successfully",
+                    "mongodb-metrics": json.dumps(results),
+                }
+            if summary is not None:
+                results["profile"] = json.dumps(summary)
+            event.set_results(results)
         except Exception as e:
             event.fail(f"Failed Patch Application: {e}")
+        finally:
+            self._on_config_changed(None)
+
+    def _report_progress(self, event, message):
+        """Report the progress of the MongoDB migrations in the action log and unit status.
+
+        The status is restored from the configuration when the action finishes.
+        """
+        event.log(message)
+        self.unit.status = MaintenanceStatus(f"Migrating: {message}")
+
+    @staticmethod
+    def _profile(event, name):
+        """Return a context profiling the action if the profile param is set.
+
+        Without the param the context does nothing and yields None.
+        """
+        if event.params.get("profile"):
+            return profile(name)
+        return nullcontext()
+
+    @staticmethod
+    def _mongo_options(params):
+        """Return the options of the MongoDB migrations set in the action params."""
+        return {
+            "mode": params.get("execution-mode", AUTO_MODE),
+            "partitions": params.get("partitions", 1),
+            "workers": params.get("workers", 0),
+            "engine": params.get("engine", SYNC_ENGINE),
+            "in_flight_writes": params.get("in-flight-writes", DEFAULT_IN_FLIGHT_WRITES),
+            "dry_run": params.get("dry-run", False),
+            "resume": params.get("resume", False),
+            "force": params.get("force", False),
+        }
+
+    @staticmethod
+    def _parse_bug_numbers(bug_numbers):
+        """Parse a comma separated list of bug numbers, or "all", dropping repeated ones."""
+        if bug_numbers.strip() == ALL_PATCHES:
+            return ALL_PATCHES
+        try:
+            bug_numbers = [int(bug_number) for bug_number in bug_numbers.split(",")]
+        except ValueError:
+            raise Exception(f"invalid bug numbers {bug_numbers}.")
+        return list(dict.fromkeys(bug_numbers))
 
 
 if __name__ == "__main__":  # pragma: no cover
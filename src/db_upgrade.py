@@ -4,244 +4,2033 @@
 
 """Upgrade DB charm module."""
 
+import asyncio
+import copy
+import hashlib
 import json
 import logging
+import math
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from functools import partial
 
-from pymongo import MongoClient
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import ExecutionTimeout
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BATCH_SIZE = 1000
+# Maximum size of the updates that a BulkWriter keeps before writing them.
+DEFAULT_WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+SAMPLES_PER_PARTITION = 20
+# Start method of the worker processes. Forking the charm while its threads hold locks
+# could deadlock the workers, so they are started from a clean server process.
+WORKERS_START_METHOD = "forkserver"
+DRY_RUN_SAMPLE_SIZE = 1000
+# Batches of a range waiting to be transformed or written, per transform worker.
+PENDING_BATCHES_PER_WORKER = 2
+DEFAULT_IN_FLIGHT_WRITES = 2
+# The p95 write latency of a throttled run is computed over the last LATENCY_WINDOW writes,
+# once there are at least LATENCY_MIN_SAMPLES of them.
+LATENCY_WINDOW = 20
+LATENCY_MIN_SAMPLES = 5
+MIN_THROTTLED_BATCH_SIZE = 10
+# Seconds of the write rates that can be saved up while nothing is written, and then
+# written at once.
+RATE_BURST = 1
+# Seconds between progress reports, and maximum time to count the candidates of a step
+# before falling back to the estimated size of its collection.
+PROGRESS_INTERVAL = 30
+COUNT_TIMEOUT_MS = 5000
+CHECKPOINTS_COLLECTION = "upgrade_checkpoints"
+LEDGER_COLLECTION = "upgrade_ledger"
+LEDGER_ID = "osm"
+KUBE_SYSTEM_PREFIX = {"$regex": "^kube-system:"}
+
+AUTO_MODE = "auto"
+SERVER_MODE = "server"
+CLIENT_MODE = "client"
+EXECUTION_MODES = (AUTO_MODE, SERVER_MODE, CLIENT_MODE)
+# Engines running the client-side migrations: threads blocking on every call, or an
+# asyncio loop overlapping the reads, transforms and writes of each _id range.
+SYNC_ENGINE = "sync"
+ASYNC_ENGINE = "asyncio"
+ENGINES = (SYNC_ENGINE, ASYNC_ENGINE)
+# Updates with an aggregation pipeline are supported since MongoDB 4.2.
+PIPELINE_UPDATE_VERSION = (4, 2)
+# Bug numbers value of apply_patches that applies every patch.
+ALL_PATCHES = "all"
+# Client-side migrations read the documents undecoded, and decode them only if needed.
+RAW_DOCUMENTS = CodecOptions(document_class=RawBSONDocument)
+
+_MISSING = object()
+
+
+class UpgradeContext:
+    """Connection and settings shared by all the steps of an upgrade or patch run.
+
+    It owns a single pooled MongoClient, so chained steps pay the connection handshake
+    once, and caches the collection names and server version the steps check. It is used
+    as a context manager so the client is closed when the run finishes.
+
+    With workers, client-side transforms run in a pool of that many processes, shared by
+    all the steps and closed with the context. The asyncio engine runs them instead with up
+    to `in_flight_writes` batches being written at once by every _id range.
+
+    If a maximum write rate or latency is set, the writes of client-side migrations are
+    paced by a shared Throttle, and auto mode runs every migration client-side, as
+    server-side updates cannot be throttled.
+
+    In a dry run the migrations only estimate their work, which is added to `results` by
+    collection. Otherwise, the metrics of every step are added to `results` by name. With
+    resume, client-side migrations continue from their checkpoints. Migrations recorded in
+    the ledger are skipped, unless forced.
+
+    If a progress function is given, it is called with a report of the running steps every
+    PROGRESS_INTERVAL seconds while the context is entered.
+    """
+
+    def __init__(
+        self,
+        mongo_uri,
+        batch_size=DEFAULT_BATCH_SIZE,
+        mode=AUTO_MODE,
+        concurrency=DEFAULT_CONCURRENCY,
+        partitions=1,
+        dry_run=False,
+        resume=False,
+        force=False,
+        workers=0,
+        engine=SYNC_ENGINE,
+        in_flight_writes=DEFAULT_IN_FLIGHT_WRITES,
+        max_write_rate=0,
+        max_write_bytes_rate=0,
+        max_write_latency=0,
+        write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+        progress=None,
+        **client_options,
+    ):
+        if mode not in EXECUTION_MODES:
+            raise Exception(f"invalid execution mode {mode}.")
+        if engine not in ENGINES:
+            raise Exception(f"invalid engine {engine}.")
+        if engine == ASYNC_ENGINE and workers:
+            raise Exception("workers are not supported by the asyncio engine.")
+        self.batch_size = batch_size
+        self.mode = mode
+        self.concurrency = concurrency
+        self.partitions = partitions
+        self.workers = workers
+        self.pool = None
+        self.engine = engine
+        self.in_flight_writes = in_flight_writes
+        self.write_buffer_size = write_buffer_size
+        self.progress = Progress(progress) if progress else None
+        self.throttle = None
+        if max_write_rate or max_write_bytes_rate or max_write_latency:
+            writes = concurrency * partitions
+            if engine == ASYNC_ENGINE:
+                writes *= in_flight_writes
+            self.throttle = Throttle(
+                batch_size,
+                writes,
+                max_documents=max_write_rate,
+                max_bytes=max_write_bytes_rate,
+                latency_threshold=max_write_latency / 1000,
+            )
+        self.dry_run = dry_run
+        self.resume = resume
+        self.force = force
+        self.results = {}
+        self.client = MongoClient(mongo_uri, **client_options)
+        self.osm_db = self.client["osm"]
+        self.ledger = Ledger(self.osm_db.get_collection(LEDGER_COLLECTION))
+        self._lock = threading.Lock()
+        self._collection_names = None
+        self._server_version = None
+
+    def __enter__(self):
+        """Start the worker processes and the progress reports, if needed."""
+        if self.workers:
+            self.pool = _process_pool(self.workers)
+        if self.progress:
+            self.progress.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the client, even if the run failed."""
+        self.close()
+
+    def close(self):
+        """Stop the progress reports and worker processes, and close the client."""
+        if self.progress:
+            self.progress.stop()
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        self.client.close()
+
+    def has_collection(self, name):
+        """Check if the collection exists, listing the collections only once per run."""
+        with self._lock:
+            if self._collection_names is None:
+                self._collection_names = set(self.osm_db.list_collection_names())
+        return name in self._collection_names
+
+    def add_result(self, name, result):
+        """Add the result of a migration: its plan by collection, or its metrics by name."""
+        with self._lock:
+            self.results[name] = result
+
+    def server_side(self, pipeline=False):
+        """Check if a step that supports it must be run as a server-side update.
+
+        In auto mode, steps that need pipeline updates are only run server-side if the
+        MongoDB server supports them, and no step is run server-side if the writes are
+        throttled. Steps without a server-side form ignore the mode. Dry runs evaluate every
+        step client-side.
+        """
+        if self.dry_run or self.mode == CLIENT_MODE:
+            return False
+        if self.mode == SERVER_MODE:
+            return True
+        if self.throttle:
+            return False
+        if not pipeline:
+            return True
+        with self._lock:
+            if self._server_version is None:
+                version_array = self.osm_db.client.server_info()["versionArray"]
+                self._server_version = tuple(version_array[:2])
+        return self._server_version >= PIPELINE_UPDATE_VERSION
+
+
+def _get_field(document, path):
+    """Return the value of the dotted path in the document, or _MISSING if it is not set."""
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+def _diff(old, new, path, update):
+    """Add to the update the narrowest $set and $unset paths that turn old into new.
+
+    Embedded documents and lists of the same length are compared item by item, so a
+    change in a nested field sets only that field instead of the whole document or list.
+    """
+    if new is _MISSING:
+        if old is not _MISSING:
+            update.setdefault("$unset", {})[path] = ""
+    elif isinstance(old, dict) and isinstance(new, dict) and _valid_keys(old, new):
+        for key, value in new.items():
+            _diff(old.get(key, _MISSING), value, f"{path}.{key}", update)
+        for key in old.keys() - new.keys():
+            update.setdefault("$unset", {})[f"{path}.{key}"] = ""
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff(old_item, new_item, f"{path}.{index}", update)
+    elif type(old) is not type(new) or old != new:
+        update.setdefault("$set", {})[path] = new
+
+
+def _valid_keys(*documents):
+    """Check if the keys of the documents can be used in dotted update paths."""
+    return all(
+        isinstance(key, str) and key and "." not in key and not key.startswith("$")
+        for document in documents
+        for key in document
+    )
+
+
+def _falsy(expression):
+    """Aggregation expression that is true when the value would be falsy in Python."""
+    return {"$in": [{"$ifNull": [expression, None]}, {"$literal": [None, "", 0, False, {}, []]}]}
+
+
+class BulkWriter:
+    """Send update operations to a collection in unordered bulk_write batches.
+
+    Operations queued with update_one() are flushed every `batch_size` operations and
+    once more when leaving the context manager. The matched and modified counts of every
+    flushed batch are kept in `batches`.
+
+    If the documents were read with a `projection`, every updated field must be covered
+    by it, so that a migration never writes back data that it did not read.
+
+    A batch is also flushed when its updates reach `buffer_size` bytes, so the memory
+    held by the pending operations is bounded whatever the size of the documents.
+
+    With a Throttle, the batches are written when it allows it, and are no bigger than
+    its current batch size. The written batches are recorded in `metrics`, if given.
+    """
+
+    def __init__(
+        self,
+        collection,
+        batch_size=DEFAULT_BATCH_SIZE,
+        projection=None,
+        throttle=None,
+        buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+        metrics=None,
+    ):
+        if batch_size < 1:
+            raise Exception(f"invalid batch size {batch_size}.")
+        if buffer_size < 1:
+            raise Exception(f"invalid write buffer size {buffer_size}.")
+        self.collection = collection
+        self.batch_size = batch_size
+        self.projection = projection
+        self.throttle = throttle
+        self.buffer_size = buffer_size
+        self.metrics = metrics
+        self.batches = []
+        self._operations = []
+        self._bytes = 0
+
+    def __enter__(self):
+        """Return the writer itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Flush the pending operations if no exception was raised."""
+        if exc_type is None:
+            self.flush()
+
+    def update_one(self, query, update):
+        """Queue an UpdateOne operation, flushing the batch when it is full."""
+        if self.projection is not None:
+            self._check_projection(update)
+        self._operations.append(UpdateOne(query, update))
+        self._bytes += len(bson.encode(update))
+        batch_size = self.batch_size
+        if self.throttle:
+            batch_size = min(batch_size, self.throttle.batch_size)
+        if len(self._operations) >= batch_size or self._bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the pending operations with a single unordered bulk_write."""
+        if not self._operations:
+            return
+        if self.throttle:
+            with self.throttle.write(len(self._operations), self._bytes):
+                start = time.monotonic()
+                result = self.collection.bulk_write(self._operations, ordered=False)
+        else:
+            start = time.monotonic()
+            result = self.collection.bulk_write(self._operations, ordered=False)
+        latency = time.monotonic() - start
+        self.batches.append((result.matched_count, result.modified_count))
+        if self.metrics:
+            self.metrics.write(result.matched_count, result.modified_count, self._bytes, latency)
+        logger.debug(
+            f"Batch {len(self.batches)} of {self.collection.name}: "
+            f"{result.matched_count} matched, {result.modified_count} modified"
+        )
+        self._operations = []
+        self._bytes = 0
+
+    def _check_projection(self, update):
+        """Raise an exception if the update writes a field not covered by the projection."""
+        for fields in update.values():
+            for path in fields:
+                if path == "_id" or any(
+                    path == field or path.startswith(f"{field}.") for field in self.projection
+                ):
+                    continue
+                raise Exception(
+                    f"update of {path} in {self.collection.name} is not covered by the projection."
+                )
+
+    @property
+    def matched_count(self):
+        """Number of documents matched by all the flushed batches."""
+        return sum(matched for matched, _ in self.batches)
+
+    @property
+    def modified_count(self):
+        """Number of documents modified by all the flushed batches."""
+        return sum(modified for _, modified in self.batches)
+
+
+class Throttle:
+    """Limits of the writes of the client-side migrations of a run.
+
+    The writes are paced so that the run stays under `max_documents` and `max_bytes`
+    written per second, when they are set. Each rate is a token bucket holding at most
+    RATE_BURST seconds of it, so time without writes, like a long read-only scan, does not
+    let the next writes go out at once. With a `latency_threshold`, in seconds, the p95
+    latency of the last writes is checked after every write: above the threshold, the
+    batch size and the number of concurrent writes are halved, and below half of it they
+    grow again step by step, up to their initial values.
+    """
+
+    def __init__(self, batch_size, concurrency, max_documents=0, max_bytes=0, latency_threshold=0):
+        self.max_batch_size = batch_size
+        self.max_concurrency = concurrency
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.latency_threshold = latency_threshold
+        self.documents = 0
+        self.bytes = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._writing = 0
+        self._condition = threading.Condition()
+        # Time at which the writes accepted so far keep to each rate.
+        self._documents_ready = self._bytes_ready = time.monotonic()
+
+    @contextmanager
+    def write(self, documents, size):
+        """Wait until the write of the documents is allowed, and time it."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._writing < self.concurrency)
+            self._writing += 1
+            self.documents += documents
+            self.bytes += size
+            delay = self._delay(documents, size)
+        try:
+            if delay > 0:
+                time.sleep(delay)
+            start = time.monotonic()
+            yield
+            latency = time.monotonic() - start
+        finally:
+            with self._condition:
+                self._writing -= 1
+                self._condition.notify_all()
+        with self._condition:
+            self._adapt(latency)
+
+    def _delay(self, documents, size):
+        """Return the seconds to wait so the write of the documents keeps to the rates."""
+        now = time.monotonic()
+        seconds = 0
+        if self.max_documents:
+            self._documents_ready = (
+                max(self._documents_ready, now - RATE_BURST) + documents / self.max_documents
+            )
+            seconds = max(seconds, self._documents_ready - now)
+        if self.max_bytes:
+            self._bytes_ready = max(self._bytes_ready, now - RATE_BURST) + size / self.max_bytes
+            seconds = max(seconds, self._bytes_ready - now)
+        return seconds
+
+    def _adapt(self, latency):
+        """Adapt the batch size and concurrency to the p95 latency of the last writes."""
+        if not self.latency_threshold:
+            return
+        self.latencies.append(latency)
+        if len(self.latencies) < LATENCY_MIN_SAMPLES:
+            return
+        p95 = _percentile(sorted(self.latencies), 95)
+        if p95 > self.latency_threshold:
+            self.batch_size = max(MIN_THROTTLED_BATCH_SIZE, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+        elif p95 < self.latency_threshold / 2 and (
+            self.batch_size < self.max_batch_size or self.concurrency < self.max_concurrency
+        ):
+            step = max(1, self.max_batch_size // 10)
+            self.batch_size = min(self.max_batch_size, self.batch_size + step)
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        else:
+            return
+        logger.info(
+            f"Write p95 latency {p95:.3f}s, throttled to batches of {self.batch_size} "
+            f"and {self.concurrency} concurrent writes"
+        )
+        # The next adaptation only looks at the writes with the new limits.
+        self.latencies.clear()
+
+
+class Metrics:
+    """Counters and timings of a migration step, updated by all the threads of the step."""
+
+    def __init__(self, name, collection):
+        self.name = name
+        self.collection = collection
+        self.execution = CLIENT_MODE
+        self.seconds = 0
+        self.scanned = 0
+        self.matched = 0
+        self.modified = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.batches = 0
+        self.latencies = []
+        # Documents read in this run, updated while the step runs to report its progress.
+        self.documents_read = 0
+        self._lock = threading.Lock()
+
+    def read(self, size):
+        """Record the read of a document of `size` bytes."""
+        with self._lock:
+            self.documents_read += 1
+            self.bytes_read += size
+
+    def write(self, matched, modified, size, latency):
+        """Record a batch write and its latency in seconds.
+
+        `matched` and `modified` are the counts reported by MongoDB for the batch, so that
+        they mean the same as the ones of a server-side update.
+        """
+        with self._lock:
+            self.batches += 1
+            self.matched += matched
+            self.modified += modified
+            self.bytes_written += size
+            self.latencies.append(latency)
+
+    def as_dict(self):
+        """Return the metrics as a dictionary that can be serialized as JSON."""
+        latencies = sorted(self.latencies)
+        return {
+            "collection": self.collection,
+            "execution": self.execution,
+            "seconds": round(self.seconds, 3),
+            "scanned": self.scanned,
+            "matched": self.matched,
+            "modified": self.modified,
+            "bytes-read": self.bytes_read,
+            "bytes-written": self.bytes_written,
+            "batches": self.batches,
+            "write-latency": {
+                f"p{percentile}": round(_percentile(latencies, percentile), 4)
+                for percentile in (50, 95, 99)
+            },
+        }
+
+
+class Progress:
+    """Periodic report of the progress of the running client-side migration steps.
+
+    A thread calls `report` every `interval` seconds, while any step is running, with the
+    percentage of the candidates of every step that were read, its rate in documents per
+    second and its estimated time left. The steps only count the documents they read, so
+    reporting costs nothing to them.
+    """
+
+    def __init__(self, report, interval=PROGRESS_INTERVAL):
+        self.report = report
+        self.interval = interval
+        self._steps = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the reporting thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the reporting thread."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def add(self, metrics, total):
+        """Report the progress of a step, with the metrics it updates, out of `total`."""
+        with self._lock:
+            self._steps[metrics.name] = (metrics, total, time.monotonic())
+
+    def remove(self, metrics):
+        """Stop reporting the progress of a finished step."""
+        with self._lock:
+            self._steps.pop(metrics.name, None)
+
+    def message(self):
+        """Return the progress of the running steps, or None if none is running."""
+        with self._lock:
+            steps = list(self._steps.values())
+        if not steps:
+            return None
+        return "; ".join(_step_progress(*step) for step in steps)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            message = self.message()
+            if not message:
+                continue
+            try:
+                self.report(message)
+            except Exception as e:
+                logger.warning(f"Failed to report the progress: {e}")
+
+
+def _step_progress(metrics, total, start):
+    """Return the progress of a step: percentage, documents per second and time left."""
+    done = metrics.documents_read
+    rate = done / max(time.monotonic() - start, 1e-3)
+    percent = min(100, 100 * done // total) if total else 100
+    message = f"{metrics.name} {percent}% ({done}/{total}), {rate:.0f} docs/s"
+    if rate and done < total:
+        message += f", ETA {timedelta(seconds=round((total - done) / rate))}"
+    return message
+
+
+def _percentile(values, percentile):
+    """Return the percentile of the sorted values, with the nearest-rank method, or 0."""
+    if not values:
+        return 0
+    return values[math.ceil(len(values) * percentile / 100) - 1]
+
+
+def _migrate(
+    collection,
+    query,
+    projection,
+    transform,
+    batch_size=DEFAULT_BATCH_SIZE,
+    partitions=1,
+    checkpoint=None,
+    needs_update=None,
+    workers=0,
+    engine=SYNC_ENGINE,
+    in_flight_writes=DEFAULT_IN_FLIGHT_WRITES,
+    throttle=None,
+    buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    metrics=None,
+    pool=None,
+):
+    """Apply a client-side transform to the candidate documents of a collection.
+
+    The transform gets a copy of every document found with the query and projection, and
+    returns it migrated. Only the fields whose value changed are written back, with the
+    narrowest update paths, so documents that are already migrated cost one read and no
+    write. The cursors fetch `batch_size` documents at a time, and the pending updates of
+    every BulkWriter are flushed when they reach `buffer_size` bytes, so the memory used
+    does not grow with the size of the collection.
+
+    The documents are read as RawBSONDocument. If needs_update is set, it is called with
+    the raw document, and the documents it rejects are never decoded nor transformed.
+
+    With more than one partition, the candidates are split in _id ranges that are migrated
+    in parallel, each one with its own cursor and BulkWriter.
+
+    If a Checkpoint is given, the progress of every range is saved in it after each batch,
+    and the ranges it already has, from an interrupted run, are resumed.
+
+    With workers, the transforms run in a pool of processes instead of the reading thread,
+    so that CPU-heavy transforms are not serialized by the GIL. The transform and
+    needs_update functions must then be picklable. The pool of the run is given in `pool`;
+    without it, a pool of `workers` processes is started for this call.
+
+    The asyncio engine migrates every range in a task that prefetches the next batch
+    while the previous ones are transformed and written, with up to `in_flight_writes`
+    batch writes at once. pymongo has no asyncio API, so its calls run in threads.
+
+    If a Throttle is given, every batch write waits until it allows it. The bytes read and
+    the batches written are recorded in `metrics`, if given.
+
+    Returns the number of scanned and modified documents.
+    """
+    if partitions < 1:
+        raise Exception(f"invalid number of partitions {partitions}.")
+    if workers < 0:
+        raise Exception(f"invalid number of workers {workers}.")
+    if in_flight_writes < 1:
+        raise Exception(f"invalid number of in-flight writes {in_flight_writes}.")
+    if checkpoint and checkpoint.ranges:
+        id_ranges = checkpoint.ranges
+    else:
+        id_ranges = _id_ranges(collection, query, partitions)
+        if checkpoint:
+            checkpoint.start(id_ranges)
+    if workers and pool is None:
+        processes = _process_pool(workers)
+    else:
+        processes = nullcontext(pool)
+    migrate_range = partial(
+        _migrate_range_in_pool if workers else _migrate_range,
+        collection,
+        query,
+        projection,
+        transform,
+        batch_size,
+        checkpoint=checkpoint,
+        needs_update=needs_update,
+        throttle=throttle,
+        buffer_size=buffer_size,
+        metrics=metrics,
+    )
+    with processes as pool:
+        if workers:
+            migrate_range = partial(migrate_range, pool=pool, workers=workers)
+        if engine == ASYNC_ENGINE:
+            migrate_ranges = _migrate_ranges_async(
+                collection,
+                query,
+                projection,
+                transform,
+                batch_size,
+                id_ranges,
+                checkpoint,
+                needs_update,
+                in_flight_writes,
+                throttle,
+                buffer_size,
+                metrics,
+            )
+            results = asyncio.run(migrate_ranges)
+        elif len(id_ranges) == 1:
+            results = [migrate_range(0, id_ranges[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(id_ranges)) as executor:
+                results = list(executor.map(migrate_range, range(len(id_ranges)), id_ranges))
+    scanned = sum(range_scanned for range_scanned, _ in results)
+    modified = sum(range_modified for _, range_modified in results)
+    logger.info(f"{collection.name}: {scanned} scanned, {modified} modified")
+    return scanned, modified
+
+
+def _process_pool(workers):
+    """Return a pool of `workers` processes started with WORKERS_START_METHOD."""
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(WORKERS_START_METHOD)
+    )
+
+
+def _migrate_range(
+    collection,
+    query,
+    projection,
+    transform,
+    batch_size,
+    index,
+    id_range,
+    checkpoint=None,
+    needs_update=None,
+    throttle=None,
+    buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    metrics=None,
+):
+    """Migrate the documents of the query in the _id range, in _id order.
+
+    Returns the scanned and modified counts of the range, including the ones of the run
+    that it resumes.
+    """
+    scanned = id_range["scanned"]
+    modified = id_range["modified"]
+    writer = BulkWriter(collection, batch_size, projection, throttle, buffer_size, metrics)
+    with writer, _scan(collection, query, projection, id_range, batch_size, metrics) as cursor:
+        for document in cursor:
+            scanned += 1
+            update = _update(document, projection, transform, needs_update)
+            if update:
+                modified += 1
+                writer.update_one({"_id": document["_id"]}, update)
+            if checkpoint and scanned % batch_size == 0:
+                writer.flush()
+                checkpoint.update(index, document["_id"], scanned, modified)
+    return scanned, modified
+
+
+@contextmanager
+def _scan(collection, query, projection, id_range, batch_size, metrics=None):
+    """Open a cursor over the raw documents of the query in the _id range, in _id order.
+
+    The cursor fetches `batch_size` documents at a time. It does not time out while the
+    batches are transformed and written, so it is always closed when leaving the context.
+    The size of the documents read is recorded in `metrics`, if given.
+    """
+    raw_collection = collection.with_options(codec_options=RAW_DOCUMENTS)
+    cursor = raw_collection.find(
+        _range_query(query, id_range),
+        projection,
+        sort=[("_id", 1)],
+        batch_size=batch_size,
+        no_cursor_timeout=True,
+    )
+    try:
+        yield _measure_reads(cursor, metrics) if metrics else cursor
+    finally:
+        cursor.close()
+
+
+def _measure_reads(cursor, metrics):
+    """Yield the documents of the cursor, recording their size in the metrics."""
+    for document in cursor:
+        metrics.read(_bson_size(document))
+        yield document
+
+
+def _bson_size(document):
+    """Return the size of the document in BSON."""
+    if isinstance(document, RawBSONDocument):
+        return len(document.raw)
+    return len(bson.encode(document))
+
+
+async def _migrate_ranges_async(
+    collection,
+    query,
+    projection,
+    transform,
+    batch_size,
+    id_ranges,
+    checkpoint,
+    needs_update,
+    in_flight_writes,
+    throttle,
+    buffer_size,
+    metrics,
+):
+    """Migrate the _id ranges concurrently in the running loop.
+
+    Returns the scanned and modified counts of every range.
+    """
+    # Every range reads one batch and writes up to in_flight_writes batches at once.
+    threads = len(id_ranges) * (in_flight_writes + 1)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        migrate_range = partial(
+            _migrate_range_async,
+            executor,
+            collection,
+            query,
+            projection,
+            transform,
+            batch_size,
+            checkpoint=checkpoint,
+            needs_update=needs_update,
+            in_flight_writes=in_flight_writes,
+            throttle=throttle,
+            buffer_size=buffer_size,
+            metrics=metrics,
+        )
+        return await asyncio.gather(
+            *(migrate_range(index, id_range) for index, id_range in enumerate(id_ranges))
+        )
+
+
+async def _migrate_range_async(
+    executor,
+    collection,
+    query,
+    projection,
+    transform,
+    batch_size,
+    index,
+    id_range,
+    checkpoint=None,
+    needs_update=None,
+    in_flight_writes=DEFAULT_IN_FLIGHT_WRITES,
+    throttle=None,
+    buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    metrics=None,
+):
+    """Migrate the documents of the query in the _id range, overlapping reads and writes.
+
+    The next batch is read while the last one is transformed and written. The writes are
+    awaited in order, so the checkpoint is only saved up to batches that are written, as
+    the writes of later batches may still be running.
+    """
+    loop = asyncio.get_running_loop()
+    scanned = id_range["scanned"]
+    modified = id_range["modified"]
+    write = partial(
+        _write_batch,
+        collection,
+        projection,
+        transform,
+        needs_update,
+        throttle,
+        buffer_size,
+        metrics,
+    )
+    writes = deque()
+    with _scan(collection, query, projection, id_range, batch_size, metrics) as cursor:
+        read = partial(_read_batch, iter(cursor), batch_size)
+        reading = loop.run_in_executor(executor, read)
+        try:
+            while True:
+                documents = await reading
+                if not documents:
+                    break
+                reading = loop.run_in_executor(executor, read)
+                scanned += len(documents)
+                writing = loop.run_in_executor(executor, write, documents)
+                writes.append((writing, documents[-1]["_id"], scanned))
+                if len(writes) >= in_flight_writes:
+                    written = writes.popleft()
+                    modified = await _commit_write(executor, written, modified, index, checkpoint)
+            while writes:
+                written = writes.popleft()
+                modified = await _commit_write(executor, written, modified, index, checkpoint)
+        finally:
+            # Let the running reads and writes finish before the cursor and the executor
+            # are closed.
+            await asyncio.gather(
+                reading, *(writing for writing, _, _ in writes), return_exceptions=True
+            )
+    return scanned, modified
+
+
+def _read_batch(cursor, batch_size):
+    """Return the next batch of documents of the cursor, empty when it is exhausted."""
+    documents = []
+    for document in cursor:
+        documents.append(document)
+        if len(documents) == batch_size:
+            break
+    return documents
+
+
+def _write_batch(
+    collection, projection, transform, needs_update, throttle, buffer_size, metrics, documents
+):
+    """Transform a batch of documents and write their updates in one bulk_write.
+
+    Returns the number of modified documents.
+    """
+    modified = 0
+    writer = BulkWriter(collection, len(documents), projection, throttle, buffer_size, metrics)
+    with writer:
+        for document in documents:
+            update = _update(document, projection, transform, needs_update)
+            if update:
+                modified += 1
+                writer.update_one({"_id": document["_id"]}, update)
+    return modified
+
+
+async def _commit_write(executor, write, modified, index, checkpoint):
+    """Await the oldest batch write of a range and save the checkpoint up to its batch.
+
+    Returns the modified count of the range with the batch.
+    """
+    writing, last, scanned = write
+    modified += await writing
+    if checkpoint:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, checkpoint.update, index, last, scanned, modified)
+    return modified
+
+
+def _migrate_range_in_pool(
+    collection,
+    query,
+    projection,
+    transform,
+    batch_size,
+    index,
+    id_range,
+    checkpoint=None,
+    needs_update=None,
+    throttle=None,
+    buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    metrics=None,
+    pool=None,
+    workers=1,
+):
+    """Migrate the documents of the _id range, transforming them in the process pool.
+
+    The calling thread reads the raw documents and submits them in batches to the pool.
+    A writer thread waits for the transformed batches in order, and writes their updates
+    and checkpoints. The queue between them is bounded, so the reader waits when the
+    workers or the writer fall behind.
+    """
+    batches = queue.Queue(maxsize=workers * PENDING_BATCHES_PER_WORKER)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        writing = executor.submit(
+            _write_batches,
+            collection,
+            batch_size,
+            projection,
+            index,
+            id_range,
+            checkpoint,
+            batches,
+            throttle,
+            buffer_size,
+            metrics,
+        )
+        try:
+            scanned = id_range["scanned"]
+            documents = []
+            scan = _scan(collection, query, projection, id_range, batch_size, metrics)
+            with scan as cursor:
+                for document in cursor:
+                    scanned += 1
+                    documents.append(document.raw)
+                    if len(documents) == batch_size:
+                        future = pool.submit(
+                            _transform_batch, documents, projection, transform, needs_update
+                        )
+                        _put_batch(batches, (future, document["_id"], scanned), writing)
+                        documents = []
+            if documents:
+                future = pool.submit(
+                    _transform_batch, documents, projection, transform, needs_update
+                )
+                _put_batch(batches, (future, None, scanned), writing)
+        finally:
+            _put_batch(batches, None, writing)
+        modified = writing.result()
+    return scanned, modified
+
+
+def _put_batch(batches, batch, writing):
+    """Queue a batch for the writer, raising its exception if it failed."""
+    while True:
+        if writing.done():
+            writing.result()
+            return
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def _write_batches(
+    collection,
+    batch_size,
+    projection,
+    index,
+    id_range,
+    checkpoint,
+    batches,
+    throttle=None,
+    buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    metrics=None,
+):
+    """Write the updates of the transformed batches, until the None batch.
+
+    Every full batch is flushed and saved in the checkpoint, as in _migrate_range. Returns
+    the modified count of the range.
+    """
+    modified = id_range["modified"]
+    writer = BulkWriter(collection, batch_size, projection, throttle, buffer_size, metrics)
+    with writer:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            future, last, scanned = batch
+            for _id, update in future.result():
+                modified += 1
+                writer.update_one({"_id": _id}, update)
+            if checkpoint and last is not None:
+                writer.flush()
+                checkpoint.update(index, last, scanned, modified)
+    return modified
+
+
+def _transform_batch(documents, projection, transform, needs_update):
+    """Return the _id and update of the raw documents of a batch that the transform changes.
+
+    It runs in the workers of the process pool.
+    """
+    updates = []
+    for raw in documents:
+        document = RawBSONDocument(raw, RAW_DOCUMENTS)
+        update = _update(document, projection, transform, needs_update)
+        if update:
+            updates.append((document["_id"], update))
+    return updates
+
+
+def _update(document, projection, transform, needs_update=None):
+    """Return the update that migrates the projected fields of the document."""
+    if needs_update and not needs_update(document):
+        return {}
+    migrated = transform(_decode(document))
+    if isinstance(document, RawBSONDocument):
+        document = bson.decode(document.raw)
+    update = {}
+    for path in projection:
+        _diff(_get_field(document, path), _get_field(migrated, path), path, update)
+    return update
+
+
+def _decode(document):
+    """Return a mutable copy of the document, decoding it if it is a RawBSONDocument.
+
+    Decoding the raw bytes again is cheaper than a deep copy of the decoded document.
+    """
+    if isinstance(document, RawBSONDocument):
+        return bson.decode(document.raw)
+    return copy.deepcopy(document)
+
+
+def _plan(
+    collection,
+    query,
+    projection,
+    transform,
+    sample_size=DRY_RUN_SAMPLE_SIZE,
+    needs_update=None,
+):
+    """Estimate the work of a client-side migration without writing.
+
+    The candidates are counted, and the transform is applied to a random sample of up to
+    `sample_size` of them, so that the estimation is not biased towards the oldest
+    documents. The documents and bytes that would be written and the duration are
+    extrapolated from the sample; the duration covers reading and transforming the
+    documents, as the cost of the writes cannot be measured without writing. The server
+    scans and sorts all the candidates to sample them before it returns the first
+    document, which a migration does not do, so the duration is measured from then.
+    """
+    candidates = collection.count_documents(query)
+    sampled = modified = written = 0
+    raw_collection = collection.with_options(codec_options=RAW_DOCUMENTS)
+    pipeline = [{"$match": query}, {"$sample": {"size": sample_size}}]
+    if projection:
+        pipeline.append({"$project": projection})
+    documents = iter(raw_collection.aggregate(pipeline))
+    document = next(documents, None)
+    start = time.monotonic()
+    while document is not None:
+        sampled += 1
+        update = _update(document, projection, transform, needs_update)
+        if update:
+            modified += 1
+            written += len(bson.encode(update))
+        document = next(documents, None)
+    elapsed = time.monotonic() - start
+    scale = candidates / sampled if sampled else 0
+    return {
+        "candidates": candidates,
+        "sampled": sampled,
+        "would-modify": round(modified * scale),
+        "bytes": round(written * scale),
+        "estimated-seconds": round(elapsed * scale, 3),
+    }
+
+
+def _id_ranges(collection, query, partitions):
+    """Split the candidates of the query in up to `partitions` consecutive _id ranges.
+
+    The range boundaries are quantiles of a random sample of the candidate _ids, so that
+    every range gets about the same number of documents. Each range also has the last
+    processed _id and the counters of its migration.
+    """
+    bounds = []
+    if partitions > 1:
+        bounds = _partition_bounds(collection, query, partitions)
+    return [
+        {"lower": lower, "upper": upper, "last": None, "scanned": 0, "modified": 0}
+        for lower, upper in zip([None] + bounds, bounds + [None])
+    ]
+
+
+def _partition_bounds(collection, query, partitions):
+    """Return the _ids that split the candidates of the query in `partitions` ranges."""
+    sample = collection.aggregate(
+        [
+            {"$match": query},
+            {"$sample": {"size": partitions * SAMPLES_PER_PARTITION}},
+            {"$project": {"_id": 1}},
+        ]
+    )
+    try:
+        ids = sorted({document["_id"] for document in sample})
+    except TypeError:
+        logger.warning(f"{collection.name} has _ids of different types, it is not partitioned")
+        return []
+    if not ids:
+        return []
+    return sorted({ids[len(ids) * i // partitions] for i in range(1, partitions)})
+
+
+def _range_query(query, id_range):
+    """Restrict the query to the documents of the _id range not processed yet."""
+    id_query = {}
+    if id_range["last"] is not None:
+        id_query["$gt"] = id_range["last"]
+    elif id_range["lower"] is not None:
+        id_query["$gte"] = id_range["lower"]
+    if id_range["upper"] is not None:
+        id_query["$lt"] = id_range["upper"]
+    return {"$and": [query, {"_id": id_query}]} if id_query else query
+
+
+class Checkpoint:
+    """Progress of a client-side migration, saved in the checkpoints collection.
+
+    It has the _id ranges of the migration, with the last processed _id and the counters of
+    each one, so an interrupted migration can be resumed from its last committed batch. The
+    checkpoint is deleted when the migration finishes.
+    """
+
+    def __init__(self, checkpoints, name, collection):
+        self.checkpoints = checkpoints
+        self.name = name
+        self.collection = collection
+        self.ranges = []
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the ranges saved by an interrupted run of the migration, if any."""
+        document = self.checkpoints.find_one({"_id": self.name})
+        if document:
+            logger.info(f"Resuming migration {self.name} from its checkpoint")
+            self.ranges = document["ranges"]
+
+    def start(self, ranges):
+        """Save the ranges of a new run of the migration."""
+        with self._lock:
+            self.ranges = ranges
+            self._save()
+
+    def update(self, index, last, scanned, modified):
+        """Save the progress of a range, once its batch up to `last` is written."""
+        with self._lock:
+            self.ranges[index].update(last=last, scanned=scanned, modified=modified)
+            self._save()
+
+    def finish(self):
+        """Delete the checkpoint of the finished migration."""
+        self.checkpoints.delete_one({"_id": self.name})
+
+    def _save(self):
+        document = {
+            "collection": self.collection,
+            "ranges": self.ranges,
+            "saved": datetime.utcnow(),
+        }
+        self.checkpoints.replace_one({"_id": self.name}, document, upsert=True)
+
+
+class Step:
+    """Migration step of an upgrade or patch.
+
+    The function is called with the UpgradeContext of the run. Steps that touch different
+    collections can run in parallel, unless one of them depends on the other.
+    """
+
+    def __init__(self, name, collection, function, depends_on=()):
+        self.name = name
+        self.collection = collection
+        self.function = function
+        self.depends_on = tuple(depends_on)
+
+
+def _run_steps(context, steps):
+    """Run the steps in a thread pool sharing the MongoDB client of the context.
+
+    A step is started once the steps it depends on have finished and no other running or
+    earlier step uses the same collection, so steps of the same collection run in the
+    given order. Up to `context.concurrency` steps run at the same time.
+    """
+    concurrency = context.concurrency
+    if concurrency < 1:
+        raise Exception(f"invalid concurrency {concurrency}.")
+    _validate_steps(steps)
+    pending = list(steps)
+    running = {}
+    done = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while pending or running:
+            for step in _ready_steps(pending, running.values(), done, concurrency):
+                logger.debug(f"Starting step {step.name}")
+                pending.remove(step)
+                running[executor.submit(step.function, context)] = step
+            if not running:
+                raise Exception(f"circular dependency between steps {[s.name for s in pending]}.")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                future.result()
+                done.add(step.name)
+
+
+def _validate_steps(steps):
+    """Check that the steps only depend on steps of the list."""
+    names = {step.name for step in steps}
+    for step in steps:
+        for dependency in step.depends_on:
+            if dependency not in names:
+                raise Exception(f"step {step.name} depends on unknown step {dependency}.")
+
+
+def _ready_steps(pending, running, done, concurrency):
+    """Return the pending steps that can be started now, in order."""
+    busy = {step.collection for step in running}
+    ready = []
+    for step in pending:
+        if len(running) + len(ready) >= concurrency:
+            break
+        if step.collection not in busy and done.issuperset(step.depends_on):
+            ready.append(step)
+        busy.add(step.collection)
+    return ready
+
+
+class Migration:
+    """Migration of the documents of a collection.
+
+    The query must select every document that the transform may change, and the transform
+    must leave any other document unchanged, so that consecutive migrations of the same
+    collection can be fused in a single pass. If server_update is set, it is called with
+    the collection to run the migration as updates inside MongoDB when the execution mode
+    allows it, and returns the matched and modified counts; pipeline tells if those
+    updates need an aggregation pipeline.
+
+    needs_update is an optional cheap check of the raw document read client-side, which
+    must be true for every document that the transform changes. It lets the migration skip
+    documents without decoding them, accessing only the sub-documents it looks at.
+
+    The name identifies the migration in the ledger and the checkpoints, so it must be
+    unique. version is the revision of its logic, recorded in the ledger: it must be
+    increased whenever the transform, server_update or needs_update, or any function they
+    call, changes how documents are migrated, so that the migration runs again. A fused
+    migration keeps the migrations it is made of in `parts`.
+    """
+
+    def __init__(
+        self,
+        name,
+        collection,
+        query,
+        projection,
+        transform,
+        server_update=None,
+        pipeline=False,
+        needs_update=None,
+        version=1,
+    ):
+        self.name = name
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.transform = transform
+        self.server_update = server_update
+        self.pipeline = pipeline
+        self.needs_update = needs_update
+        self.version = version
+        self.parts = [self]
+
+    @property
+    def checksum(self):
+        """Checksum of the definition of the migration: its selection and version."""
+        definition = json.dumps(
+            [self.collection, self.query, self.projection, self.version],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(definition.encode()).hexdigest()
+
+    def server_side(self, context):
+        """Check if the migration runs server-side in the context."""
+        return self.server_update is not None and context.server_side(self.pipeline)
+
+    def fuse(self, other):
+        """Return a client-side migration that applies this migration and then the other."""
+        needs_update = None
+        if self.needs_update and other.needs_update:
+            needs_update = partial(_any_needs_update, self.needs_update, other.needs_update)
+        fused = Migration(
+            f"{self.name}+{other.name}",
+            self.collection,
+            {"$or": [self.query, other.query]},
+            _merge_projections(self.projection, other.projection),
+            partial(_chain_transforms, self.transform, other.transform),
+            needs_update=needs_update,
+        )
+        fused.parts = self.parts + other.parts
+        return fused
+
+    def run(self, context):
+        """Run the migration, if the collection exists, and record it in the ledger.
+
+        The metrics of the migration are logged and added to the results of the context.
+        """
+        if not context.has_collection(self.collection):
+            return
+        logger.info(f"Running migration {self.name}")
+        start = time.monotonic()
+        metrics = Metrics(self.name, self.collection)
+        collection = context.osm_db[self.collection]
+        if context.dry_run:
+            result = _plan(
+                collection,
+                self.query,
+                self.projection,
+                self.transform,
+                needs_update=self.needs_update,
+            )
+            context.add_result(self.collection, result)
+            return
+        if self.server_side(context):
+            scanned, modified = self.server_update(collection)
+            metrics.execution = SERVER_MODE
+            metrics.matched = scanned
+            metrics.modified = modified
+        else:
+            checkpoints = context.osm_db.get_collection(CHECKPOINTS_COLLECTION)
+            checkpoint = Checkpoint(checkpoints, self.name, self.collection)
+            if context.resume:
+                checkpoint.load()
+            if context.progress:
+                context.progress.add(metrics, _count_candidates(collection, self.query))
+            try:
+                scanned, modified = _migrate(
+                    collection,
+                    self.query,
+                    self.projection,
+                    self.transform,
+                    context.batch_size,
+                    context.partitions,
+                    checkpoint,
+                    self.needs_update,
+                    context.workers,
+                    context.engine,
+                    context.in_flight_writes,
+                    context.throttle,
+                    context.write_buffer_size,
+                    metrics,
+                    context.pool,
+                )
+            finally:
+                if context.progress:
+                    context.progress.remove(metrics)
+            checkpoint.finish()
+        for migration in self.parts:
+            context.ledger.record(migration, scanned, modified)
+        metrics.seconds = time.monotonic() - start
+        metrics.scanned = scanned
+        result = metrics.as_dict()
+        logger.info(f"Metrics of migration {self.name}: {json.dumps(result)}")
+        context.add_result(self.name, result)
+
+
+def _count_candidates(collection, query):
+    """Count the candidates of the query, or estimate them if counting takes too long."""
+    try:
+        return collection.count_documents(query, maxTimeMS=COUNT_TIMEOUT_MS)
+    except ExecutionTimeout:
+        logger.info(f"Counting the candidates of {collection.name} timed out, estimating them")
+        return collection.estimated_document_count()
+
+
+def _chain_transforms(first, second, document):
+    """Apply two transforms in order, as a picklable fused transform."""
+    return second(first(document))
+
+
+def _any_needs_update(first, second, document):
+    """Check if any of two needs_update functions is true, as a picklable fused check."""
+    return first(document) or second(document)
+
+
+class Ledger:
+    """Record of the migrations applied to the database, kept in a single document.
+
+    Every applied migration is recorded with the time it finished, its document counts and
+    the checksum of its definition, so it is skipped by later runs unless it changes. The
+    ledger also has the version of the last upgrade.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._document = None
+
+    def _load(self):
+        if self._document is None:
+            self._document = self.ledger.find_one({"_id": LEDGER_ID}) or {}
+        return self._document
+
+    @property
+    def version(self):
+        """Return the version of the last upgrade, or None if it is not known."""
+        return self._load().get("version")
+
+    def applied(self, migration):
+        """Check if the migration was applied, with the same definition."""
+        entry = self._load().get("migrations", {}).get(migration.name)
+        return bool(entry) and entry.get("checksum") == migration.checksum
+
+    def record(self, migration, scanned, modified):
+        """Record that the migration was applied."""
+        entry = {
+            "applied": datetime.utcnow(),
+            "scanned": scanned,
+            "modified": modified,
+            "version": migration.version,
+            "checksum": migration.checksum,
+        }
+        self._update({f"migrations.{migration.name}": entry})
+
+    def set_version(self, version):
+        """Record the version the database was upgraded to."""
+        self._update({"version": version, "upgraded": datetime.utcnow()})
+
+    def _update(self, fields):
+        self.ledger.update_one({"_id": LEDGER_ID}, {"$set": fields}, upsert=True)
+
+
+def _merge_projections(*projections):
+    """Merge inclusion projections, dropping the paths included by a parent path."""
+    paths = sorted({path for projection in projections for path in projection})
+    merged = {}
+    for path in paths:
+        if not any(path.startswith(f"{parent}.") for parent in merged):
+            merged[path] = 1
+    return merged
+
+
+def _log_server_update(name, result):
+    """Log the result of a server-side update, returning its matched and modified counts."""
+    logger.info(
+        f"{name} (server-side): {result.matched_count} matched, {result.modified_count} modified"
+    )
+    return result.matched_count, result.modified_count
+
+
+def _run_migrations(context, migrations):
+    """Run the migrations in order as steps of the context.
+
+    Consecutive client-side migrations of a collection are fused, so each document is read
+    and written once for all of them. Migrations of other collections in between do not
+    prevent the fusion, as they are independent. Migrations already recorded in the
+    ledger are skipped, unless the context is forced.
+    """
+    if not context.force:
+        pending = []
+        for migration in migrations:
+            if context.ledger.applied(migration):
+                logger.info(f"Skipping migration {migration.name}, it is already applied")
+            else:
+                pending.append(migration)
+        migrations = pending
+    fused = []
+    latest = {}
+    for migration in migrations:
+        index = latest.get(migration.collection)
+        if (
+            index is not None
+            and not fused[index].server_side(context)
+            and not migration.server_side(context)
+        ):
+            fused[index] = fused[index].fuse(migration)
+            continue
+        latest[migration.collection] = len(fused)
+        fused.append(migration)
+    steps = [Step(migration.name, migration.collection, migration.run) for migration in fused]
+    _run_steps(context, steps)
+
+
+# Functions returning the migrations of each direct upgrade between two versions, and of
+# the fix of each bug, added with the register_upgrade and register_patch decorators.
+MONGODB_UPGRADE_FUNCTIONS = {}
+MYSQL_UPGRADE_FUNCTIONS = {}
+BUG_FIXES = {}
+
+
+def register_upgrade(current, target):
+    """Register a function returning the migrations of the upgrade between two versions."""
+
+    def register(function):
+        MONGODB_UPGRADE_FUNCTIONS.setdefault(current, {}).setdefault(target, []).append(function)
+        return function
+
+    return register
+
+
+def register_patch(bug_number):
+    """Register a function returning the migrations that fix a bug."""
+
+    def register(function):
+        if bug_number in BUG_FIXES:
+            raise Exception(f"bug {bug_number} already has a patch.")
+        BUG_FIXES[bug_number] = function
+        return function
+
+    return register
+
 
 class MongoUpgrade1012:
     """Upgrade MongoDB Database from OSM v10 to v12."""
 
+    # Lists of the nsr whose items have the vim_info written by RO for every VIM.
+    NSR_VIM_INFO_LISTS = ("vld", "image", "flavor", "affinity-or-anti-affinity-group")
+    NSR_QUERY = {
+        "$or": [
+            *({f"{field}.vim_info": {"$exists": True}} for field in NSR_VIM_INFO_LISTS),
+            {"_admin.deployed.K8s.k8scluster-uuid": KUBE_SYSTEM_PREFIX},
+        ]
+    }
+    NSR_PROJECTION = {
+        **{field: 1 for field in NSR_VIM_INFO_LISTS},
+        "_admin.deployed.K8s": 1,
+    }
+    VNFR_QUERY = {"vdur": {"$elemMatch": {"vim_info": {"$exists": True, "$nin": [None, {}]}}}}
+    VNFR_PROJECTION = {"vdur": 1}
+    K8SCLUSTER_QUERY = {
+        "$or": [
+            {"_admin.helm-chart.id": KUBE_SYSTEM_PREFIX},
+            {"_admin.helm-chart-v3.id": KUBE_SYSTEM_PREFIX},
+        ]
+    }
+    K8SCLUSTER_PROJECTION = {"_admin.helm-chart.id": 1, "_admin.helm-chart-v3.id": 1}
+
     @staticmethod
-    def _remove_namespace_from_k8s(nsrs, nsr):
+    def _remove_namespace_from_k8s(nsr):
+        """Return the deployed K8s of the nsr without "kube-system:" in k8scluster-uuid."""
         namespace = "kube-system:"
-        if nsr["_admin"].get("deployed"):
-            k8s_list = []
-            for k8s in nsr["_admin"]["deployed"].get("K8s"):
-                if k8s.get("k8scluster-uuid"):
-                    k8s["k8scluster-uuid"] = k8s["k8scluster-uuid"].replace(namespace, "", 1)
-                k8s_list.append(k8s)
-            myquery = {"_id": nsr["_id"]}
-            nsrs.update_one(myquery, {"$set": {"_admin.deployed.K8s": k8s_list}})
+        k8s_list = []
+        for k8s in nsr["_admin"]["deployed"].get("K8s", []):
+            if k8s.get("k8scluster-uuid"):
+                k8s["k8scluster-uuid"] = k8s["k8scluster-uuid"].replace(namespace, "", 1)
+            k8s_list.append(k8s)
+        return k8s_list
 
     @staticmethod
-    def _update_nsr(osm_db):
-        """Update nsr.
+    def _transform_nsr(nsr):
+        """Add vim_message to the items with vim_info and remove the namespace of K8s."""
+        for values in nsr.values():
+            if isinstance(values, list):
+                for value in values:
+                    if isinstance(value, dict) and value.get("vim_info"):
+                        index = list(value["vim_info"].keys())[0]
+                        if not value["vim_info"][index].get("vim_message"):
+                            value["vim_info"][index]["vim_message"] = None
+        if nsr.get("_admin", {}).get("deployed"):
+            nsr["_admin"]["deployed"]["K8s"] = MongoUpgrade1012._remove_namespace_from_k8s(nsr)
+        return nsr
 
-        Add vim_message = None if it does not exist.
-        Remove "namespace:" from k8scluster-uuid.
-        """
-        if "nsrs" not in osm_db.list_collection_names():
-            return
-        logger.info("Entering in MongoUpgrade1012._update_nsr function")
-
-        nsrs = osm_db["nsrs"]
-        for nsr in nsrs.find():
-            logger.debug(f"Updating {nsr['_id']} nsr")
-            for key, values in nsr.items():
-                if isinstance(values, list):
-                    item_list = []
-                    for value in values:
-                        if isinstance(value, dict) and value.get("vim_info"):
-                            index = list(value["vim_info"].keys())[0]
-                            if not value["vim_info"][index].get("vim_message"):
-                                value["vim_info"][index]["vim_message"] = None
-                            item_list.append(value)
-                    myquery = {"_id": nsr["_id"]}
-                    nsrs.update_one(myquery, {"$set": {key: item_list}})
-            MongoUpgrade1012._remove_namespace_from_k8s(nsrs, nsr)
+    @staticmethod
+    def _transform_vnfr(vnfr):
+        """Add vim_message to vdur and copy interfaces into interfaces_backup."""
+        for vdur in vnfr.get("vdur", []):
+            if vdur.get("vim_info"):
+                index = list(vdur["vim_info"].keys())[0]
+                if not vdur["vim_info"][index].get("vim_message"):
+                    vdur["vim_info"][index]["vim_message"] = None
+                if vdur["vim_info"][index].get(
+                    "interfaces", "Not found"
+                ) != "Not found" and not vdur["vim_info"][index].get("interfaces_backup"):
+                    vdur["vim_info"][index]["interfaces_backup"] = vdur["vim_info"][index][
+                        "interfaces"
+                    ]
+        return vnfr
 
     @staticmethod
-    def _update_vnfr(osm_db):
-        """Update vnfr.
+    def _vnfr_needs_update(vnfr):
+        """Check if the transform changes a vdur, looking only at the first vim_info."""
+        for vdur in vnfr.get("vdur") or []:
+            vim_info = vdur.get("vim_info")
+            if not vim_info:
+                continue
+            vim = next(iter(vim_info.values()))
+            vim_message = vim.get("vim_message", _MISSING)
+            if vim_message is _MISSING or (vim_message is not None and not vim_message):
+                return True
+            if "interfaces" in vim and not vim.get("interfaces_backup"):
+                return True
+        return False
 
-        Add vim_message to vdur if it does not exist.
-        Copy content of interfaces into interfaces_backup.
-        """
-        if "vnfrs" not in osm_db.list_collection_names():
-            return
-        logger.info("Entering in MongoUpgrade1012._update_vnfr function")
-        mycol = osm_db["vnfrs"]
-        for vnfr in mycol.find():
-            logger.debug(f"Updating {vnfr['_id']} vnfr")
-            vdur_list = []
-            for vdur in vnfr["vdur"]:
-                if vdur.get("vim_info"):
-                    index = list(vdur["vim_info"].keys())[0]
-                    if not vdur["vim_info"][index].get("vim_message"):
-                        vdur["vim_info"][index]["vim_message"] = None
-                    if vdur["vim_info"][index].get(
-                        "interfaces", "Not found"
-                    ) != "Not found" and not vdur["vim_info"][index].get("interfaces_backup"):
-                        vdur["vim_info"][index]["interfaces_backup"] = vdur["vim_info"][index][
-                            "interfaces"
+    @staticmethod
+    def _transform_k8scluster(k8scluster):
+        """Remove the namespace from the helm-chart and helm-chart-v3 ids."""
+        namespace = "kube-system:"
+        for chart in ("helm-chart", "helm-chart-v3"):
+            helm_chart = k8scluster["_admin"].get(chart)
+            if helm_chart and helm_chart.get("id") and helm_chart["id"].startswith(namespace):
+                helm_chart["id"] = helm_chart["id"].replace(namespace, "", 1)
+        return k8scluster
+
+    @staticmethod
+    def _vnfr_pipeline():
+        """Pipeline update equivalent to the client-side transform of _update_vnfr."""
+        first_vim = {
+            "$let": {
+                "vars": {"first": {"$arrayElemAt": [{"$objectToArray": "$$vdur.vim_info"}, 0]}},
+                "in": "$$first.k",
+            }
+        }
+        vim_message = {
+            "vim_message": {"$cond": [_falsy("$$vim.v.vim_message"), None, "$$vim.v.vim_message"]}
+        }
+        interfaces_backup = {
+            "$cond": [
+                {
+                    "$and": [
+                        {"$ne": [{"$type": "$$vim.v.interfaces"}, "missing"]},
+                        _falsy("$$vim.v.interfaces_backup"),
+                    ]
+                },
+                {"interfaces_backup": "$$vim.v.interfaces"},
+                {},
+            ]
+        }
+        vim_info = {
+            "$arrayToObject": {
+                "$map": {
+                    "input": {"$objectToArray": "$$vdur.vim_info"},
+                    "as": "vim",
+                    "in": {
+                        "$cond": [
+                            {"$eq": ["$$vim.k", first_vim]},
+                            {
+                                "k": "$$vim.k",
+                                "v": {
+                                    "$mergeObjects": ["$$vim.v", vim_message, interfaces_backup]
+                                },
+                            },
+                            "$$vim",
                         ]
-                vdur_list.append(vdur)
-            myquery = {"_id": vnfr["_id"]}
-            mycol.update_one(myquery, {"$set": {"vdur": vdur_list}})
+                    },
+                }
+            }
+        }
+        vdur = {
+            "$cond": [
+                _falsy("$$vdur.vim_info"),
+                "$$vdur",
+                {"$mergeObjects": ["$$vdur", {"vim_info": vim_info}]},
+            ]
+        }
+        return [{"$set": {"vdur": {"$map": {"input": "$vdur", "as": "vdur", "in": vdur}}}}]
 
     @staticmethod
-    def _update_k8scluster(osm_db):
-        """Remove namespace from helm-chart and helm-chart-v3 id."""
-        if "k8sclusters" not in osm_db.list_collection_names():
-            return
-        logger.info("Entering in MongoUpgrade1012._update_k8scluster function")
+    def _k8scluster_pipeline():
+        """Pipeline update removing "kube-system:" from the ids of both helm charts.
+
+        The charts are merged into _admin, so that a chart that the cluster does not have is
+        not created.
+        """
         namespace = "kube-system:"
-        k8sclusters = osm_db["k8sclusters"]
-        for k8scluster in k8sclusters.find():
-            if k8scluster["_admin"].get("helm-chart") and k8scluster["_admin"]["helm-chart"].get(
-                "id"
-            ):
-                if k8scluster["_admin"]["helm-chart"]["id"].startswith(namespace):
-                    k8scluster["_admin"]["helm-chart"]["id"] = k8scluster["_admin"]["helm-chart"][
-                        "id"
-                    ].replace(namespace, "", 1)
-            if k8scluster["_admin"].get("helm-chart-v3") and k8scluster["_admin"][
-                "helm-chart-v3"
-            ].get("id"):
-                if k8scluster["_admin"]["helm-chart-v3"]["id"].startswith(namespace):
-                    k8scluster["_admin"]["helm-chart-v3"]["id"] = k8scluster["_admin"][
-                        "helm-chart-v3"
-                    ]["id"].replace(namespace, "", 1)
-            myquery = {"_id": k8scluster["_id"]}
-            k8sclusters.update_one(myquery, {"$set": k8scluster})
+        charts = {}
+        for chart in ("helm-chart", "helm-chart-v3"):
+            chart_id = f"$_admin.{chart}.id"
+            has_namespace = {
+                "$and": [
+                    {"$eq": [{"$type": chart_id}, "string"]},
+                    {"$eq": [{"$indexOfCP": [chart_id, namespace]}, 0]},
+                ]
+            }
+            without_namespace = {
+                "$substrCP": [
+                    chart_id,
+                    len(namespace),
+                    {"$subtract": [{"$strLenCP": chart_id}, len(namespace)]},
+                ]
+            }
+            charts[chart] = {
+                "$cond": [
+                    has_namespace,
+                    {"$mergeObjects": [f"$_admin.{chart}", {"id": without_namespace}]},
+                    f"$_admin.{chart}",
+                ]
+            }
+        return [{"$set": {"_admin": {"$mergeObjects": ["$_admin", charts]}}}]
 
     @staticmethod
-    def upgrade(mongo_uri):
-        """Upgrade nsr, vnfr and k8scluster in DB."""
-        logger.info("Entering in MongoUpgrade1012.upgrade function")
-        myclient = MongoClient(mongo_uri)
-        osm_db = myclient["osm"]
-        MongoUpgrade1012._update_nsr(osm_db)
-        MongoUpgrade1012._update_vnfr(osm_db)
-        MongoUpgrade1012._update_k8scluster(osm_db)
+    def _update_vnfr_server_side(vnfrs):
+        """Add vim_message and interfaces_backup to the vdur with an update pipeline."""
+        result = vnfrs.update_many(MongoUpgrade1012.VNFR_QUERY, MongoUpgrade1012._vnfr_pipeline())
+        return _log_server_update("vnfrs", result)
+
+    @staticmethod
+    def _update_k8scluster_server_side(k8sclusters):
+        """Remove the namespace from the helm chart ids with an update pipeline."""
+        result = k8sclusters.update_many(
+            MongoUpgrade1012.K8SCLUSTER_QUERY, MongoUpgrade1012._k8scluster_pipeline()
+        )
+        return _log_server_update("k8sclusters", result)
+
+    @staticmethod
+    @register_upgrade("10", "12")
+    def migrations():
+        """Migrations of nsr, vnfr and k8scluster.
+
+        Add vim_message = None to the vim_info of nsr and vnfr if it does not exist.
+        Copy content of interfaces into interfaces_backup.
+        Remove "namespace:" from k8scluster-uuid and the helm chart ids.
+        """
+        return [
+            Migration(
+                "10-12-nsrs",
+                "nsrs",
+                MongoUpgrade1012.NSR_QUERY,
+                MongoUpgrade1012.NSR_PROJECTION,
+                MongoUpgrade1012._transform_nsr,
+                version=2,
+            ),
+            Migration(
+                "10-12-vnfrs",
+                "vnfrs",
+                MongoUpgrade1012.VNFR_QUERY,
+                MongoUpgrade1012.VNFR_PROJECTION,
+                MongoUpgrade1012._transform_vnfr,
+                MongoUpgrade1012._update_vnfr_server_side,
+                pipeline=True,
+                needs_update=MongoUpgrade1012._vnfr_needs_update,
+                version=1,
+            ),
+            Migration(
+                "10-12-k8sclusters",
+                "k8sclusters",
+                MongoUpgrade1012.K8SCLUSTER_QUERY,
+                MongoUpgrade1012.K8SCLUSTER_PROJECTION,
+                MongoUpgrade1012._transform_k8scluster,
+                MongoUpgrade1012._update_k8scluster_server_side,
+                pipeline=True,
+                version=1,
+            ),
+        ]
 
 
 class MongoUpgrade910:
     """Upgrade MongoDB Database from OSM v9 to v10."""
 
+    ALARMS_QUERY = {"alarm_status": {"$in": [None, "", False, 0]}}
+    ALARMS_PROJECTION = {"alarm_status": 1}
+
     @staticmethod
-    def upgrade(mongo_uri):
-        """Add parameter alarm status = OK if not found in alarms collection."""
-        myclient = MongoClient(mongo_uri)
-        osm_db = myclient["osm"]
-        collist = osm_db.list_collection_names()
+    def _transform_alarm(alarm):
+        """Set the alarm status to ok if it is not set."""
+        if not alarm.get("alarm_status"):
+            alarm["alarm_status"] = "ok"
+        return alarm
 
-        if "alarms" in collist:
-            mycol = osm_db["alarms"]
-            for x in mycol.find():
-                if not x.get("alarm_status"):
-                    myquery = {"_id": x["_id"]}
-                    mycol.update_one(myquery, {"$set": {"alarm_status": "ok"}})
+    @staticmethod
+    def _update_alarms_server_side(alarms):
+        """Set the alarm status to ok with an update command."""
+        result = alarms.update_many(MongoUpgrade910.ALARMS_QUERY, {"$set": {"alarm_status": "ok"}})
+        return _log_server_update("alarms", result)
+
+    @staticmethod
+    @register_upgrade("9", "10")
+    def migrations():
+        """Migration adding parameter alarm status = OK if not found in alarms collection."""
+        return [
+            Migration(
+                "9-10-alarms",
+                "alarms",
+                MongoUpgrade910.ALARMS_QUERY,
+                MongoUpgrade910.ALARMS_PROJECTION,
+                MongoUpgrade910._transform_alarm,
+                MongoUpgrade910._update_alarms_server_side,
+                version=1,
+            )
+        ]
 
 
 class MongoPatch1837:
     """Patch Bug 1837 on MongoDB."""
 
+    NSLCMOPS_QUERY = {
+        "$or": [
+            {"operationParams.additionalParamsForVnf": {"$type": "array"}},
+            {"operationParams.primitive_params": {"$type": "object"}},
+        ]
+    }
+    NSLCMOPS_PROJECTION = {
+        "operationParams.additionalParamsForVnf": 1,
+        "operationParams.primitive_params": 1,
+    }
+    VNFRS_QUERY = {
+        "kdur": {"$elemMatch": {"additionalParams": {"$ne": None, "$not": {"$type": "string"}}}}
+    }
+    VNFRS_PROJECTION = {"kdur": 1}
+
     @staticmethod
-    def _update_nslcmops_params(osm_db):
-        """Updates the nslcmops collection to change the additional params to a string."""
-        logger.info("Entering in MongoPatch1837._update_nslcmops_params function")
-        if "nslcmops" in osm_db.list_collection_names():
-            nslcmops = osm_db["nslcmops"]
-            for nslcmop in nslcmops.find():
-                if nslcmop.get("operationParams"):
-                    if nslcmop["operationParams"].get("additionalParamsForVnf") and isinstance(
-                        nslcmop["operationParams"].get("additionalParamsForVnf"), list
-                    ):
-                        string_param = json.dumps(
-                            nslcmop["operationParams"]["additionalParamsForVnf"]
-                        )
-                        myquery = {"_id": nslcmop["_id"]}
-                        nslcmops.update_one(
-                            myquery,
-                            {
-                                "$set": {
-                                    "operationParams": {"additionalParamsForVnf": string_param}
-                                }
-                            },
-                        )
-                    elif nslcmop["operationParams"].get("primitive_params") and isinstance(
-                        nslcmop["operationParams"].get("primitive_params"), dict
-                    ):
-                        string_param = json.dumps(nslcmop["operationParams"]["primitive_params"])
-                        myquery = {"_id": nslcmop["_id"]}
-                        nslcmops.update_one(
-                            myquery,
-                            {"$set": {"operationParams": {"primitive_params": string_param}}},
-                        )
+    def _transform_nslcmop(nslcmop):
+        """Change the list or dict params of the operation to a string."""
+        operation_params = nslcmop.get("operationParams")
+        if operation_params:
+            if operation_params.get("additionalParamsForVnf") and isinstance(
+                operation_params.get("additionalParamsForVnf"), list
+            ):
+                operation_params["additionalParamsForVnf"] = json.dumps(
+                    operation_params["additionalParamsForVnf"]
+                )
+            elif operation_params.get("primitive_params") and isinstance(
+                operation_params.get("primitive_params"), dict
+            ):
+                operation_params["primitive_params"] = json.dumps(
+                    operation_params["primitive_params"]
+                )
+        return nslcmop
 
     @staticmethod
-    def _update_vnfrs_params(osm_db):
-        """Updates the vnfrs collection to change the additional params to a string."""
-        logger.info("Entering in MongoPatch1837._update_vnfrs_params function")
-        if "vnfrs" in osm_db.list_collection_names():
-            mycol = osm_db["vnfrs"]
-            for vnfr in mycol.find():
-                if vnfr.get("kdur"):
-                    kdur_list = []
-                    for kdur in vnfr["kdur"]:
-                        if kdur.get("additionalParams") and not isinstance(
-                            kdur["additionalParams"], str
-                        ):
-                            kdur["additionalParams"] = json.dumps(kdur["additionalParams"])
-                        kdur_list.append(kdur)
-                    myquery = {"_id": vnfr["_id"]}
-                    mycol.update_one(
-                        myquery,
-                        {"$set": {"kdur": kdur_list}},
-                    )
-                    vnfr["kdur"] = kdur_list
+    def _transform_vnfr(vnfr):
+        """Change the additional params of the kdur to a string."""
+        for kdur in vnfr.get("kdur") or []:
+            if kdur.get("additionalParams") and not isinstance(kdur["additionalParams"], str):
+                kdur["additionalParams"] = json.dumps(kdur["additionalParams"])
+        return vnfr
 
     @staticmethod
-    def patch(mongo_uri):
-        """Updates the database to change the additional params from dict to a string."""
-        logger.info("Entering in MongoPatch1837.patch function")
-        myclient = MongoClient(mongo_uri)
-        osm_db = myclient["osm"]
-        MongoPatch1837._update_nslcmops_params(osm_db)
-        MongoPatch1837._update_vnfrs_params(osm_db)
-
-
-MONGODB_UPGRADE_FUNCTIONS = {
-    "9": {"10": [MongoUpgrade910.upgrade]},
-    "10": {"12": [MongoUpgrade1012.upgrade]},
-}
-MYSQL_UPGRADE_FUNCTIONS = {}
-BUG_FIXES = {
-    1837: MongoPatch1837.patch,
-}
+    def _vnfr_needs_update(vnfr):
+        """Check if a kdur has additional params that are not a string, without decoding them."""
+        return any(
+            kdur.get("additionalParams") and not isinstance(kdur["additionalParams"], str)
+            for kdur in vnfr.get("kdur") or []
+        )
+
+    @staticmethod
+    @register_patch(1837)
+    def migrations():
+        """Migrations changing the additional params of nslcmops and vnfrs to a string.
+
+        The params are serialized with json.dumps, so there is no server-side form of these
+        migrations and the execution mode is ignored.
+        """
+        return [
+            Migration(
+                "bug-1837-nslcmops",
+                "nslcmops",
+                MongoPatch1837.NSLCMOPS_QUERY,
+                MongoPatch1837.NSLCMOPS_PROJECTION,
+                MongoPatch1837._transform_nslcmop,
+                version=1,
+            ),
+            Migration(
+                "bug-1837-vnfrs",
+                "vnfrs",
+                MongoPatch1837.VNFRS_QUERY,
+                MongoPatch1837.VNFRS_PROJECTION,
+                MongoPatch1837._transform_vnfr,
+                needs_update=MongoPatch1837._vnfr_needs_update,
+                version=1,
+            ),
+        ]
 
 
 class MongoUpgrade:
     """Upgrade MongoDB Database."""
 
-    def __init__(self, mongo_uri):
+    def __init__(
+        self,
+        mongo_uri,
+        batch_size=DEFAULT_BATCH_SIZE,
+        concurrency=DEFAULT_CONCURRENCY,
+        pool_size=None,
+        compressors=None,
+        read_concern=None,
+        write_concern=None,
+        max_write_rate=0,
+        max_write_bytes_rate=0,
+        max_write_latency=0,
+        write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+    ):
         self.mongo_uri = mongo_uri
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.throttle_options = {
+            "max_write_rate": max_write_rate,
+            "max_write_bytes_rate": max_write_bytes_rate,
+            "max_write_latency": max_write_latency,
+        }
+        self.write_buffer_size = write_buffer_size
+        self.client_options = {}
+        if pool_size:
+            self.client_options["maxPoolSize"] = pool_size
+        if compressors:
+            self.client_options["compressors"] = compressors
+        if read_concern:
+            self.client_options["readConcernLevel"] = read_concern
+        if write_concern:
+            self.client_options["w"] = (
+                int(write_concern) if write_concern.isdigit() else write_concern
+            )
 
-    def upgrade(self, current, target):
-        """Validates the upgrading path and upgrades the DB."""
-        self._validate_upgrade(current, target)
-        for function in MONGODB_UPGRADE_FUNCTIONS.get(current)[target]:
-            function(self.mongo_uri)
+    def _run(self, migrations, options, version=None):
+        """Run the migrations in a new context with the run options, returning its results.
 
-    def _validate_upgrade(self, current, target):
-        """Check if the upgrade path chosen is possible."""
+        The options are the keyword arguments of UpgradeContext for a single run: mode,
+        partitions, dry_run, resume and force. If the run upgrades the database to a
+        version, it is recorded in the ledger.
+        """
+        with UpgradeContext(
+            self.mongo_uri,
+            batch_size=self.batch_size,
+            concurrency=self.concurrency,
+            write_buffer_size=self.write_buffer_size,
+            **self.throttle_options,
+            **options,
+            **self.client_options,
+        ) as context:
+            _run_migrations(context, migrations)
+            if version and not context.dry_run:
+                context.ledger.set_version(version)
+        return context.results
+
+    def current_version(self):
+        """Return the version of the last upgrade recorded in the ledger, or None."""
+        with UpgradeContext(self.mongo_uri, **self.client_options) as context:
+            return context.ledger.version
+
+    def upgrade(self, current, target, **options):
+        """Validates the upgrading path and upgrades the DB.
+
+        If there is no direct upgrade between the versions, the shortest chain of upgrades
+        is run in a single pass, fusing the migrations of each collection. In a dry run
+        nothing is written, and the estimated work of each collection is returned.
+        Migrations recorded in the ledger by a previous run are skipped unless forced.
+        """
+        functions = self._upgrade_path(current, target)
+        migrations = [migration for function in functions for migration in function()]
+        return self._run(migrations, options, version=target)
+
+    def _upgrade_path(self, current, target):
+        """Return the upgrade functions of the shortest path between the versions."""
         logger.info("Validating the upgrade path")
         if current not in MONGODB_UPGRADE_FUNCTIONS:
             raise Exception(f"cannot upgrade from {current} version.")
-        if target not in MONGODB_UPGRADE_FUNCTIONS[current]:
+        paths = {current: []}
+        versions = deque([current])
+        while versions:
+            version = versions.popleft()
+            for next_version, functions in MONGODB_UPGRADE_FUNCTIONS.get(version, {}).items():
+                if next_version not in paths:
+                    paths[next_version] = paths[version] + functions
+                    versions.append(next_version)
+        if target == current or target not in paths:
             raise Exception(f"cannot upgrade from version {current} to {target}.")
+        return paths[target]
+
+    def _validate_upgrade(self, current, target):
+        """Check if the upgrade path chosen is possible."""
+        self._upgrade_path(current, target)
 
-    def apply_patch(self, bug_number: int) -> None:
+    def apply_patch(self, bug_number: int, **options) -> dict:
         """Checks the bug-number and applies the fix in the database."""
-        if bug_number not in BUG_FIXES:
-            raise Exception(f"There is no patch for bug {bug_number}")
-        patch_function = BUG_FIXES[bug_number]
-        patch_function(self.mongo_uri)
+        return self.apply_patches([bug_number], **options)
+
+    def apply_patches(self, bug_numbers, **options) -> dict:
+        """Checks the bug numbers and applies all their fixes in a single pass.
+
+        The migrations of the patches are fused, so each collection is read once for all of
+        them. bug_numbers can be ALL_PATCHES to apply every patch, in bug number order.
+        A bug number given more than once is applied once, at its first position.
+        In a dry run nothing is written, and the estimated work of each collection is
+        returned.
+        """
+        if bug_numbers == ALL_PATCHES:
+            bug_numbers = sorted(BUG_FIXES)
+        bug_numbers = list(dict.fromkeys(bug_numbers))
+        for bug_number in bug_numbers:
+            if bug_number not in BUG_FIXES:
+                raise Exception(f"There is no patch for bug {bug_number}")
+        migrations = [
+            migration for bug_number in bug_numbers for migration in BUG_FIXES[bug_number]()
+        ]
+        return self._run(migrations, options)
 
 
 class MysqlUpgrade:
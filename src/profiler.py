@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Profiling of the charm actions with cProfile and tracemalloc."""
+
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Directory of the unit where the reports are saved, to fetch them with juju scp.
+PROFILE_DIR = "/var/tmp/osm-update-db"
+TOP_FUNCTIONS = 10
+TOP_ALLOCATIONS = 5
+# Allocations written in the report file, and frames saved for every allocation.
+REPORTED_ALLOCATIONS = 50
+TRACEMALLOC_FRAMES = 10
+# Before Python 3.12 a cProfile profiler only sees the thread that enables it.
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+
+@contextmanager
+def profile(name, directory=PROFILE_DIR):
+    """Profile the block with cProfile and tracemalloc, saving the reports in the directory.
+
+    Yields a dictionary that is filled with the summary of the profile when the block exits.
+    The reports are saved even if the block raises: a pstats dump of the calls of the
+    threads started in the block, and the lines that allocated most memory. Transforms run
+    in worker processes are not profiled.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    stem = directory / f"{name}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}"
+    summary = {}
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(*_):
+        # Called by the first event of every new thread, then replaced by its own profiler.
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    if PROFILE_PER_THREAD:
+        threading.setprofile(profile_thread)
+    start = time.monotonic()
+    profilers[0].enable()
+    try:
+        yield summary
+    finally:
+        profilers[0].disable()
+        seconds = time.monotonic() - start
+        if PROFILE_PER_THREAD:
+            threading.setprofile(None)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            )
+        )
+        tracemalloc.stop()
+        with lock:
+            stats = pstats.Stats(*profilers)
+        stats.dump_stats(f"{stem}.prof")
+        allocations = snapshot.statistics("lineno")
+        _write_allocations(f"{stem}-memory.txt", allocations, peak)
+        summary.update(_summary(stats, allocations, seconds, peak))
+        summary["profile-file"] = f"{stem}.prof"
+        summary["memory-file"] = f"{stem}-memory.txt"
+        logger.info(f"Saved the profile of {name} in {stem}.prof and {stem}-memory.txt")
+
+
+def _write_allocations(path, allocations, peak):
+    """Write the lines that allocated most memory, with their traceback."""
+    with open(path, "w") as report:
+        report.write(f"Peak traced memory: {peak} bytes\n")
+        for statistic in allocations[:REPORTED_ALLOCATIONS]:
+            report.write(f"\n{statistic}\n")
+            for line in statistic.traceback.format():
+                report.write(f"{line}\n")
+
+
+def _summary(stats, allocations, seconds, peak):
+    """Return the hot spots of the profile, to be returned in the action results."""
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return {
+        "seconds": round(seconds, 3),
+        "peak-memory-bytes": peak,
+        "top-functions": [
+            {
+                "function": pstats.func_std_string(function),
+                "calls": calls,
+                "own-seconds": round(own_time, 4),
+                "cumulative-seconds": round(cumulative_time, 4),
+            }
+            for function, (_, calls, own_time, cumulative_time, _) in functions[:TOP_FUNCTIONS]
+        ],
+        "top-allocations": [
+            {"line": str(statistic.traceback), "bytes": statistic.size, "blocks": statistic.count}
+            for statistic in allocations[:TOP_ALLOCATIONS]
+        ],
+    }
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Generator of synthetic OSM collections to benchmark the MongoDB migrations.
+
+The documents have the shape of the OSM records that the migrations read, with padding
+fields standing for the rest of the descriptors. A `pending` fraction of them needs every
+migration, and the rest are already migrated, as in a database upgraded before.
+"""
+
+import json
+import random
+import uuid
+
+INSERT_BATCH_SIZE = 1000
+COLLECTIONS = ("nsrs", "vnfrs", "k8sclusters", "alarms", "nslcmops")
+
+
+def _padding(rng, size):
+    """Return a nested document of about `size` bytes, standing for unrelated fields."""
+    return {
+        f"field-{i}": {"value": rng.getrandbits(32), "text": "x" * 64}
+        for i in range(max(1, size // 100))
+    }
+
+
+def _vim_info(rng, pending):
+    vim = {"vim_id": str(uuid.UUID(int=rng.getrandbits(128))), "vim_status": "ACTIVE"}
+    interfaces = [
+        {"mac_address": f"fa:16:3e:00:00:{i:02x}", "vim_net_id": "net"} for i in range(2)
+    ]
+    vim["interfaces"] = interfaces
+    if not pending:
+        vim["vim_message"] = None
+        vim["interfaces_backup"] = interfaces
+    return {f"vim:{uuid.UUID(int=rng.getrandbits(128))}": vim}
+
+
+def _ro_vim_info(rng, pending):
+    """Return the vim_info that RO writes in the image and flavor items of a nsr."""
+    vim = {"vim_id": str(uuid.UUID(int=rng.getrandbits(128))), "vim_status": "DONE"}
+    if not pending:
+        vim["vim_message"] = None
+    return {f"vim:{uuid.UUID(int=rng.getrandbits(128))}": vim}
+
+
+def nsr(rng, pending, size):
+    """Return a nsr with vim_info in its lists, a deployed K8s cluster and lists without it."""
+    prefix = "kube-system:" if pending else ""
+    return {
+        "_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "name": "ns",
+        "vld": [{"id": f"vld-{i}", "vim_info": _vim_info(rng, pending)} for i in range(2)]
+        + [{"id": "vld-mgmt"}],
+        "image": [{"id": "0", "image": "ubuntu20.04", "vim_info": _ro_vim_info(rng, pending)}],
+        "flavor": [
+            {"id": str(i), "vcpu-count": 2, "vim_info": _ro_vim_info(rng, pending)}
+            for i in range(2)
+        ],
+        "constituent-vnfr-ref": [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(2)],
+        "_admin": {
+            "deployed": {
+                "K8s": [{"k8scluster-uuid": f"{prefix}{uuid.UUID(int=rng.getrandbits(128))}"}]
+            }
+        },
+        "nsd": _padding(rng, size),
+    }
+
+
+def vnfr(rng, pending, size, vdus=10, kdus=5):
+    """Return a vnfr with `vdus` vdur with vim_info and `kdus` kdur with additional params."""
+    params = {"replicas": 3, "image": "osm/app"}
+    return {
+        "_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "vdur": [
+            {"vdu-id-ref": f"vdu-{i}", "vim_info": _vim_info(rng, pending)} for i in range(vdus)
+        ],
+        "kdur": [
+            {"kdu-name": f"kdu-{i}", "additionalParams": params if pending else json.dumps(params)}
+            for i in range(kdus)
+        ],
+        "vnfd": _padding(rng, size),
+    }
+
+
+def k8scluster(rng, pending, size):
+    """Return a k8scluster with helm chart ids."""
+    prefix = "kube-system:" if pending else ""
+    return {
+        "_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "_admin": {
+            "helm-chart": {"id": f"{prefix}{uuid.UUID(int=rng.getrandbits(128))}"},
+            "helm-chart-v3": {"id": f"{prefix}{uuid.UUID(int=rng.getrandbits(128))}"},
+        },
+        "credentials": _padding(rng, size),
+    }
+
+
+def alarm(rng, pending, size):
+    """Return an alarm, without status if it is pending."""
+    document = {"_id": str(uuid.UUID(int=rng.getrandbits(128))), "metric": "cpu_utilization"}
+    if not pending:
+        document["alarm_status"] = "ok"
+    document["tags"] = _padding(rng, size)
+    return document
+
+
+def nslcmop(rng, pending, size):
+    """Return a nslcmop with list or dict params if it is pending."""
+    vnf_params = [{"member-vnf-index": "1", "additionalParams": {"a": 1}}]
+    primitive_params = {"command": "touch", "file": "/tmp/osm"}
+    operation_params = (
+        {"additionalParamsForVnf": vnf_params}
+        if rng.random() < 0.5
+        else {"primitive_params": primitive_params}
+    )
+    if not pending:
+        operation_params = {key: json.dumps(value) for key, value in operation_params.items()}
+    operation_params["lcmOperationType"] = "action"
+    operation_params["nsInstanceId"] = str(uuid.UUID(int=rng.getrandbits(128)))
+    return {
+        "_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "operationParams": operation_params,
+        "detailed-status": _padding(rng, size),
+    }
+
+
+GENERATORS = {
+    "nsrs": nsr,
+    "vnfrs": vnfr,
+    "k8sclusters": k8scluster,
+    "alarms": alarm,
+    "nslcmops": nslcmop,
+}
+
+
+def documents(collection, count, pending=0.5, size=1000, seed=0):
+    """Yield `count` documents of the collection, a `pending` fraction of them unmigrated.
+
+    The padding of every document is about `size` bytes. The documents only depend on the
+    seed, so runs with the same arguments are comparable.
+    """
+    rng = random.Random(f"{collection}-{seed}")
+    generator = GENERATORS[collection]
+    for _ in range(count):
+        yield generator(rng, rng.random() < pending, size)
+
+
+def generate(osm_db, count, pending=0.5, size=1000, seed=0, collections=COLLECTIONS):
+    """Replace the collections of the database with `count` synthetic documents each.
+
+    Returns the number of documents inserted in every collection.
+    """
+    inserted = {}
+    for collection in collections:
+        osm_db.drop_collection(collection)
+        batch = []
+        for document in documents(collection, count, pending, size, seed):
+            batch.append(document)
+            if len(batch) == INSERT_BATCH_SIZE:
+                osm_db[collection].insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            osm_db[collection].insert_many(batch, ordered=False)
+        inserted[collection] = count
+    return inserted
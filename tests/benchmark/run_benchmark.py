@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Benchmark of the MongoDB upgrades and patches on synthetic OSM datasets.
+
+Every registered upgrade and patch is run against the `osm` database of a local mongod, after
+replacing its collections with a synthetic dataset of each scale. The throughput, peak RSS and
+round trips to the server of every case are saved as JSON, to compare the migration modes and
+engines between commits:
+
+    tox -e benchmark -- --scale 1000 --scale 100000 --output benchmark.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pymongo import MongoClient, monitoring
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parents[2] / "src"))
+
+import dataset  # noqa: E402
+
+from db_upgrade import (  # noqa: E402
+    AUTO_MODE,
+    BUG_FIXES,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_IN_FLIGHT_WRITES,
+    ENGINES,
+    EXECUTION_MODES,
+    MONGODB_UPGRADE_FUNCTIONS,
+    SYNC_ENGINE,
+    MongoUpgrade,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCALES = (1000, 10000, 100000)
+
+
+class RoundTrips(monitoring.CommandListener):
+    """Count the commands sent to the server, by command name."""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        """Count a command sent to the server."""
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        """Ignore the replies of the server."""
+
+    def failed(self, event):
+        """Ignore the failures of the commands."""
+
+
+def cases():
+    """Return the name and migration function of every upgrade and patch."""
+    upgrades = [
+        (f"upgrade-{current}-{target}", function)
+        for current, targets in sorted(MONGODB_UPGRADE_FUNCTIONS.items())
+        for target, functions in sorted(targets.items())
+        for function in functions
+    ]
+    patches = [(f"patch-{bug}", function) for bug, function in sorted(BUG_FIXES.items())]
+    return upgrades + patches
+
+
+def peak_rss():
+    """Return the peak RSS in KiB of the memory of this process since it was executed.
+
+    ru_maxrss is not used: Linux keeps in it the peak of the process before it executed a
+    new program, so the peak of a spawned process would include its parent's. VmHWM is the
+    one of its own memory.
+    """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return None
+
+
+def run_case(mongo_uri, name, scale, options, upgrade_options):
+    """Run the migrations of a case in this process, returning its measurements.
+
+    The case must run in a new spawned process, so the peak RSS of the process is the one of
+    the case: a forked process starts with the pages of its parent counted in its peak RSS.
+    """
+    function = dict(cases())[name]
+    migrations = function()
+    round_trips = RoundTrips()
+    upgrade = MongoUpgrade(mongo_uri, **upgrade_options)
+    upgrade.client_options["event_listeners"] = [round_trips]
+    start = time.monotonic()
+    results = upgrade._run(migrations, {**options, "force": True})
+    seconds = time.monotonic() - start
+    documents = scale * len({migration.collection for migration in migrations})
+    return {
+        "name": name,
+        "scale": scale,
+        "seconds": round(seconds, 3),
+        "docs-per-second": round(documents / seconds, 1) if seconds else None,
+        "peak-rss-kb": peak_rss(),
+        "round-trips": {
+            "total": sum(round_trips.commands.values()),
+            "commands": dict(round_trips.commands),
+        },
+        "steps": results,
+    }
+
+
+def parse_args(args=None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument(
+        "--scale",
+        type=int,
+        action="append",
+        help="documents of each collection, can be repeated (default: 1000, 10000, 100000)",
+    )
+    parser.add_argument("--pending", type=float, default=0.5, help="fraction to migrate")
+    parser.add_argument("--document-size", type=int, default=1000, help="padding in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--case", action="append", help="upgrade or patch to run, e.g. patch-1837")
+    parser.add_argument("--mode", choices=EXECUTION_MODES, default=AUTO_MODE)
+    parser.add_argument("--engine", choices=ENGINES, default=SYNC_ENGINE)
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--in-flight-writes", type=int, default=DEFAULT_IN_FLIGHT_WRITES)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace the collections of an osm database that is not empty",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Run the benchmark and save its report."""
+    args = parse_args(args)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    functions = dict(cases())
+    names = list(functions)
+    for name in args.case or []:
+        if name not in names:
+            raise SystemExit(f"unknown case {name}, choose from: {', '.join(names)}")
+    options = {
+        "mode": args.mode,
+        "engine": args.engine,
+        "partitions": args.partitions,
+        "workers": args.workers,
+        "in_flight_writes": args.in_flight_writes,
+    }
+    upgrade_options = {"batch_size": args.batch_size, "concurrency": args.concurrency}
+
+    client = MongoClient(args.mongo_uri)
+    osm_db = client["osm"]
+    if osm_db.list_collection_names() and not args.overwrite:
+        raise SystemExit("the osm database is not empty, use --overwrite to replace it")
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "server-version": client.server_info()["version"],
+        "options": {**options, **upgrade_options, "document-size": args.document_size},
+        "cases": [],
+    }
+    for scale in args.scale or DEFAULT_SCALES:
+        for name in args.case or names:
+            collections = sorted({migration.collection for migration in functions[name]()})
+            logger.info(
+                "Generating %s documents of %s for %s", scale, ", ".join(collections), name
+            )
+            dataset.generate(
+                osm_db, scale, args.pending, args.document_size, args.seed, collections
+            )
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                case = executor.submit(
+                    run_case, args.mongo_uri, name, scale, options, upgrade_options
+                ).result()
+            logger.info(
+                "%s at %s: %s docs/s, %s round trips, peak RSS %s KiB",
+                name,
+                scale,
+                case["docs-per-second"],
+                case["round-trips"]["total"],
+                case["peak-rss-kb"],
+            )
+            report["cases"].append(case)
+    client.close()
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    logger.info("Saved the benchmark report in %s", args.output)
+
+
+if __name__ == "__main__":
+    main()
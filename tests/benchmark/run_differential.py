@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Differential check of the optimised MongoDB migrations against a reference run.
+
+The reference runs the frozen copy, in reference.py, of the per-document migrations of the
+charm before the bulk, server-side, fused and parallel paths. Each optimised mode runs on an
+identical synthetic dataset of a local mongod, and the resulting collections are compared
+document by document with the reference. Differences that the current migrations introduced
+on purpose are listed in INTENDED_DIFFERENCES, and counted apart. The timings of the
+reference and of every mode are saved side by side as JSON, and the exit status is 1 if any
+mode has a difference that is not intended:
+
+    tox -e differential -- --scale 1000 --scale 100000 --output differential.json
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from itertools import zip_longest
+from pathlib import Path
+
+from pymongo import MongoClient
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parents[2] / "src"))
+
+import dataset  # noqa: E402
+from reference import REFERENCES  # noqa: E402
+from run_benchmark import cases  # noqa: E402
+
+from db_upgrade import (  # noqa: E402
+    ASYNC_ENGINE,
+    CLIENT_MODE,
+    PIPELINE_UPDATE_VERSION,
+    SERVER_MODE,
+    MongoUpgrade,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCALES = (1000, 10000)
+REFERENCE_DB = "osm_reference"
+# Mismatching documents reported for every collection of a mode.
+MAX_REPORTED_MISMATCHES = 10
+# Optimised modes checked against the reference, as options of a run.
+MODES = {
+    "server": {"mode": SERVER_MODE},
+    "client": {"mode": CLIENT_MODE},
+    "client-partitions": {"mode": CLIENT_MODE, "partitions": 4},
+    "client-workers": {"mode": CLIENT_MODE, "partitions": 4, "workers": 2},
+    "asyncio": {"mode": CLIENT_MODE, "partitions": 4, "engine": ASYNC_ENGINE},
+}
+# Case running every upgrade and patch together, so the migrations of a collection are fused.
+ALL_CASE = "all"
+_MISSING = object()
+
+
+def migrations_of(name):
+    """Return the migrations of a case, in the order that they are run."""
+    functions = dict(cases())
+    if name == ALL_CASE:
+        return [migration for function in functions.values() for migration in function()]
+    return functions[name]()
+
+
+def references_of(name):
+    """Return the reference functions of a case, in the order that they are run."""
+    if name == ALL_CASE:
+        return [function for case, _ in cases() for function in REFERENCES[case]]
+    return REFERENCES[name]
+
+
+def run_reference(osm_db, name):
+    """Run the reference migrations of a case in the database."""
+    for function in references_of(name):
+        function(osm_db)
+
+
+def _kept_items_without_vim_info(expected, document, path):
+    """Check if the field is a list of the nsr where the reference dropped the items.
+
+    The reference replaced every list of the nsr with its items that have vim_info.
+    """
+    value = document.get(path)
+    return isinstance(value, list) and expected.get(path) == [
+        item for item in value if isinstance(item, dict) and item.get("vim_info")
+    ]
+
+
+def _kept_operation_params(expected, document, path):
+    """Check if the field is an operation param of the nslcmop that the reference dropped.
+
+    The reference replaced operationParams with the only param it converted to a string.
+    """
+    parts = path.split(".")
+    return (
+        len(parts) == 2
+        and parts[0] == "operationParams"
+        and parts[1] not in expected.get("operationParams", {})
+        and parts[1] in document.get("operationParams", {})
+    )
+
+
+# Differences of the current migrations with the reference that are intended, by collection:
+# name and check of the differing field, given the reference document, the document and the
+# path of the field.
+INTENDED_DIFFERENCES = {
+    "nsrs": [("nsr-items-without-vim-info-kept", _kept_items_without_vim_info)],
+    "nslcmops": [("nslcmop-operation-params-kept", _kept_operation_params)],
+}
+
+
+def _differences(reference, document, path=""):
+    """Return the paths of the fields that differ between two documents."""
+    if isinstance(reference, dict) and isinstance(document, dict):
+        return [
+            difference
+            for key in sorted(set(reference) | set(document), key=str)
+            for difference in _differences(
+                reference.get(key, _MISSING),
+                document.get(key, _MISSING),
+                f"{path}.{key}" if path else str(key),
+            )
+        ]
+    if (
+        isinstance(reference, list)
+        and isinstance(document, list)
+        and len(reference) == len(document)
+    ):
+        return [
+            difference
+            for index, (item, other) in enumerate(zip(reference, document))
+            for difference in _differences(item, other, f"{path}.{index}")
+        ]
+    return [] if reference == document else [path]
+
+
+def _intended(collection, expected, document, fields):
+    """Return the names of the intended differences explaining every differing field.
+
+    Returns None if any field differs in a way that is not intended.
+    """
+    names = set()
+    for field in fields:
+        for name, check in INTENDED_DIFFERENCES.get(collection, []):
+            if check(expected, document, field):
+                names.add(name)
+                break
+        else:
+            return None
+    return names
+
+
+def compare(reference, collection):
+    """Compare the documents of a collection with the reference, in _id order.
+
+    Returns the number of documents compared, the number that differ, the number of them
+    by intended difference, and the _id and differing fields of the first documents with
+    differences that are not intended. A document missing from one of the collections
+    differs as a whole.
+    """
+    compared = mismatched = 0
+    intended = {}
+    mismatches = []
+    documents = zip_longest(reference.find(sort=[("_id", 1)]), collection.find(sort=[("_id", 1)]))
+    for expected, document in documents:
+        compared += 1
+        if expected == document:
+            continue
+        fields = [""]
+        if expected is not None and document is not None:
+            fields = _differences(expected, document)
+            names = _intended(collection.name, expected, document, fields)
+            if names is not None:
+                for name in names:
+                    intended[name] = intended.get(name, 0) + 1
+                continue
+        mismatched += 1
+        if len(mismatches) < MAX_REPORTED_MISMATCHES:
+            mismatches.append({"_id": str((expected or document)["_id"]), "fields": fields})
+    return {
+        "documents": compared,
+        "mismatched": mismatched,
+        "intended": intended,
+        "mismatches": mismatches,
+    }
+
+
+def check_case(upgrade, osm_db, reference_db, name, scale, modes, args):
+    """Run a case in the reference and in every mode, and compare their collections."""
+    migrations = migrations_of(name)
+    collections = sorted({migration.collection for migration in migrations})
+    dataset.generate(reference_db, scale, args.pending, args.document_size, args.seed, collections)
+    start = time.monotonic()
+    run_reference(reference_db, name)
+    case = {
+        "name": name,
+        "scale": scale,
+        "reference-seconds": round(time.monotonic() - start, 3),
+        "modes": {},
+    }
+    for mode in modes:
+        dataset.generate(osm_db, scale, args.pending, args.document_size, args.seed, collections)
+        start = time.monotonic()
+        upgrade._run(migrations_of(name), {**MODES[mode], "force": True})
+        seconds = time.monotonic() - start
+        comparison = {
+            collection: compare(reference_db[collection], osm_db[collection])
+            for collection in collections
+        }
+        mismatched = sum(result["mismatched"] for result in comparison.values())
+        logger.info(
+            "%s at %s in %s mode: %s s (reference %s s), %s unintended differences",
+            name,
+            scale,
+            mode,
+            round(seconds, 3),
+            case["reference-seconds"],
+            mismatched,
+        )
+        case["modes"][mode] = {
+            "seconds": round(seconds, 3),
+            "matches-reference": not mismatched,
+            "collections": comparison,
+        }
+    return case
+
+
+def parse_args(args=None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument(
+        "--scale",
+        type=int,
+        action="append",
+        help="documents of each collection, can be repeated (default: 1000, 10000)",
+    )
+    parser.add_argument("--pending", type=float, default=0.5, help="fraction to migrate")
+    parser.add_argument("--document-size", type=int, default=1000, help="padding in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--case", action="append", help=f"upgrade or patch to run, or {ALL_CASE}")
+    parser.add_argument("--mode", action="append", choices=MODES, help="optimised mode to check")
+    parser.add_argument("--output", default="differential.json")
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace the collections of osm databases that are not empty",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Run the differential check and save its report, exiting with 1 on any difference."""
+    args = parse_args(args)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    names = [name for name, _ in cases()] + [ALL_CASE]
+    for name in args.case or []:
+        if name not in names:
+            raise SystemExit(f"unknown case {name}, choose from: {', '.join(names)}")
+    for name, _ in cases():
+        if name not in REFERENCES:
+            raise SystemExit(f"{name} has no reference migrations in reference.py")
+
+    client = MongoClient(args.mongo_uri)
+    osm_db, reference_db = client["osm"], client[REFERENCE_DB]
+    for db in (osm_db, reference_db):
+        if db.list_collection_names() and not args.overwrite:
+            raise SystemExit(f"the {db.name} database is not empty, use --overwrite to replace it")
+    server_version = client.server_info()["version"]
+    modes = args.mode or list(MODES)
+    if tuple(client.server_info()["versionArray"][:2]) < PIPELINE_UPDATE_VERSION:
+        logger.info("Skipping the server mode, MongoDB %s has no update pipelines", server_version)
+        modes = [mode for mode in modes if MODES[mode]["mode"] != SERVER_MODE]
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "server-version": server_version,
+        "cases": [],
+    }
+    upgrade = MongoUpgrade(args.mongo_uri)
+    for scale in args.scale or DEFAULT_SCALES:
+        for name in args.case or names:
+            report["cases"].append(
+                check_case(upgrade, osm_db, reference_db, name, scale, modes, args)
+            )
+    client.close()
+
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    logger.info("Saved the differential report in %s", args.output)
+    matching = all(
+        result["matches-reference"]
+        for case in report["cases"]
+        for result in case["modes"].values()
+    )
+    return 0 if matching else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
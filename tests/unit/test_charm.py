@@ -3,8 +3,9 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, Mock, patch
 
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from ops.testing import Harness
@@ -12,6 +13,21 @@ from ops.testing import Harness
 from charm import UpgradeDBCharm
 
 
+def mongo_options(**options):
+    return {
+        "mode": "auto",
+        "partitions": 1,
+        "workers": 0,
+        "engine": "sync",
+        "in_flight_writes": 2,
+        "progress": ANY,
+        "dry_run": False,
+        "resume": False,
+        "force": False,
+        **options,
+    }
+
+
 class TestCharm(unittest.TestCase):
     def setUp(self):
         self.harness = Harness(UpgradeDBCharm)
@@ -67,18 +83,51 @@ class TestCharm(unittest.TestCase):
     @patch("charm.MysqlUpgrade")
     def test_update_db_mongo(self, mock_mysql_upgrade, mock_mongo_upgrade):
         self.harness.update_config({"mongodb-uri": "foo"})
+        mock_mongo_upgrade().upgrade.return_value = {}
         action_event = Mock(
             params={
                 "current-version": 7,
                 "target-version": 10,
                 "mysql-only": False,
                 "mongodb-only": True,
+                "execution-mode": "server",
+                "partitions": 4,
+                "engine": "asyncio",
+                "in-flight-writes": 4,
+                "resume": True,
             }
         )
         self.harness.charm._on_update_db_action(action_event)
-        mock_mongo_upgrade().upgrade.assert_called_once()
+        mock_mongo_upgrade().upgrade.assert_called_once_with(
+            "7",
+            "10",
+            **mongo_options(
+                mode="server",
+                partitions=4,
+                engine="asyncio",
+                in_flight_writes=4,
+                resume=True,
+            ),
+        )
         mock_mysql_upgrade.assert_not_called()
 
+    @patch("charm.MongoUpgrade")
+    @patch("charm.MysqlUpgrade")
+    def test_update_db_metrics(self, mock_mysql_upgrade, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo", "mysql-uri": "bar"})
+        metrics = {"10-12-nsrs": {"collection": "nsrs", "scanned": 10, "modified": 2}}
+        mock_mongo_upgrade().upgrade.return_value = metrics
+        action_event = Mock(params={"current-version": 10, "target-version": 12})
+        self.harness.charm._on_update_db_action(action_event)
+        action_event.fail.assert_not_called()
+        action_event.set_results.assert_called_once_with(
+            {
+                "mysql": "Upgraded successfully",
+                "mongodb": "Upgraded successfully",
+                "mongodb-metrics": json.dumps(metrics),
+            }
+        )
+
     @patch("charm.MongoUpgrade")
     def test_update_db_not_configured_mongo_fail(self, mock_mongo_upgrade):
         action_event = Mock(
@@ -130,6 +179,145 @@ class TestCharm(unittest.TestCase):
         mock_mysql_upgrade().upgrade.assert_called_once()
         mock_mongo_upgrade().upgrade.assert_called_once()
 
+    @patch("charm.MongoUpgrade")
+    @patch("charm.MysqlUpgrade")
+    def test_update_db_dry_run(self, mock_mysql_upgrade, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo", "mysql-uri": "bar"})
+        plan = {"vnfrs": {"candidates": 10, "would-modify": 5}}
+        mock_mongo_upgrade().upgrade.return_value = plan
+        action_event = Mock(params={"current-version": 9, "target-version": 12, "dry-run": True})
+        self.harness.charm._on_update_db_action(action_event)
+        mock_mongo_upgrade().upgrade.assert_called_once_with(
+            "9", "12", **mongo_options(dry_run=True)
+        )
+        mock_mysql_upgrade().upgrade.assert_not_called()
+        action_event.set_results.assert_called_once_with({"mongodb": plan})
+
+    def test_update_db_dry_run_mysql_fail(self):
+        action_event = Mock(
+            params={
+                "current-version": 9,
+                "target-version": 10,
+                "mysql-only": True,
+                "dry-run": True,
+            }
+        )
+        self.harness.charm._on_update_db_action(action_event)
+        self.assertEqual(
+            action_event.fail.call_args,
+            [("Failed DB Upgrade: dry-run is only supported for mongodb",)],
+        )
+
+    @patch("charm.MongoUpgrade")
+    def test_apply_patch_dry_run(self, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        plan = {"nslcmops": {"candidates": 3}}
+        mock_mongo_upgrade().apply_patch.return_value = plan
+        action_event = Mock(params={"bug-number": 1837, "dry-run": True})
+        self.harness.charm._on_apply_patch_action(action_event)
+        mock_mongo_upgrade().apply_patch.assert_called_once_with(
+            1837, **mongo_options(dry_run=True)
+        )
+        action_event.set_results.assert_called_once_with({"mongodb": plan})
+
+    @patch("charm.MongoUpgrade")
+    def test_update_db_current_version_from_ledger(self, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        mock_mongo_upgrade().current_version.return_value = "10"
+        action_event = Mock(params={"target-version": 12, "mongodb-only": True, "force": True})
+        self.harness.charm._on_update_db_action(action_event)
+        mock_mongo_upgrade().upgrade.assert_called_once_with(
+            "10", "12", **mongo_options(force=True)
+        )
+        mock_mongo_upgrade().current_version.return_value = None
+        self.harness.charm._on_update_db_action(action_event)
+        self.assertEqual(
+            action_event.fail.call_args,
+            [
+                (
+                    "Failed DB Upgrade: current-version not set and not found in the "
+                    "migration ledger",
+                )
+            ],
+        )
+
+    @patch("charm.MongoUpgrade")
+    def test_update_db_progress(self, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        statuses = []
+
+        def upgrade(current, target, progress, **options):
+            progress("10-12-vnfrs 50% (5/10), 1 docs/s, ETA 0:00:05")
+            statuses.append(self.harness.model.unit.status)
+            return {}
+
+        mock_mongo_upgrade().upgrade.side_effect = upgrade
+        action_event = Mock(
+            params={"current-version": 10, "target-version": 12, "mongodb-only": True}
+        )
+        self.harness.charm._on_update_db_action(action_event)
+        action_event.log.assert_called_once_with("10-12-vnfrs 50% (5/10), 1 docs/s, ETA 0:00:05")
+        self.assertEqual(
+            statuses,
+            [MaintenanceStatus("Migrating: 10-12-vnfrs 50% (5/10), 1 docs/s, ETA 0:00:05")],
+        )
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    @patch("charm.profile")
+    @patch("charm.MongoUpgrade")
+    def test_update_db_profile(self, mock_mongo_upgrade, mock_profile):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        mock_mongo_upgrade().upgrade.return_value = {}
+        mock_profile.return_value.__enter__.return_value = {"seconds": 1.5}
+        action_event = Mock(
+            params={
+                "current-version": 10,
+                "target-version": 12,
+                "mongodb-only": True,
+                "profile": True,
+            }
+        )
+        self.harness.charm._on_update_db_action(action_event)
+        mock_profile.assert_called_once_with("update-db")
+        action_event.set_results.assert_called_once_with(
+            {
+                "mongodb": "Upgraded successfully",
+                "mongodb-metrics": "{}",
+                "profile": '{"seconds": 1.5}',
+            }
+        )
+
+    @patch("charm.profile")
+    @patch("charm.MongoUpgrade")
+    def test_update_db_without_profile(self, mock_mongo_upgrade, mock_profile):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        mock_mongo_upgrade().upgrade.return_value = {}
+        action_event = Mock(
+            params={"current-version": 10, "target-version": 12, "mongodb-only": True}
+        )
+        self.harness.charm._on_update_db_action(action_event)
+        mock_profile.assert_not_called()
+        action_event.set_results.assert_called_once_with(
+            {"mongodb": "Upgraded successfully", "mongodb-metrics": "{}"}
+        )
+
+    @patch("charm.profile")
+    @patch("charm.MongoUpgrade")
+    def test_apply_patch_profile(self, mock_mongo_upgrade, mock_profile):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        mock_mongo_upgrade().apply_patch.return_value = {}
+        mock_profile.return_value.__enter__.return_value = {"seconds": 1.5}
+        action_event = Mock(params={"bug-number": 1837, "profile": True})
+        self.harness.charm._on_apply_patch_action(action_event)
+        mock_profile.assert_called_once_with("apply-patch")
+        action_event.set_results.assert_called_once_with(
+            {
+                "mongodb": "Patched successfully",
+                "mongodb-metrics": "{}",
+                "profile": '{"seconds": 1.5}',
+            }
+        )
+
     @patch("charm.MongoUpgrade")
     def test_apply_patch(self, mock_mongo_upgrade):
         self.harness.update_config({"mongodb-uri": "foo"})
@@ -138,8 +326,76 @@ class TestCharm(unittest.TestCase):
                 "bug-number": 57,
             }
         )
+        mock_mongo_upgrade().apply_patch.return_value = {"bug-1837-vnfrs": {"scanned": 1}}
         self.harness.charm._on_apply_patch_action(action_event)
-        mock_mongo_upgrade().apply_patch.assert_called_once()
+        mock_mongo_upgrade().apply_patch.assert_called_once_with(57, **mongo_options())
+        action_event.set_results.assert_called_once_with(
+            {
+                "mongodb": "Patched successfully",
+                "mongodb-metrics": '{"bug-1837-vnfrs": {"scanned": 1}}',
+            }
+        )
+
+    @patch("charm.MongoUpgrade")
+    def test_apply_patches(self, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        action_event = Mock(params={"bug-numbers": "1837, 57", "partitions": 2})
+        self.harness.charm._on_apply_patch_action(action_event)
+        mock_mongo_upgrade().apply_patches.assert_called_once_with(
+            [1837, 57], **mongo_options(partitions=2)
+        )
+        action_event = Mock(params={"bug-numbers": "1837,1837"})
+        self.harness.charm._on_apply_patch_action(action_event)
+        mock_mongo_upgrade().apply_patches.assert_called_with([1837], **mongo_options())
+        action_event = Mock(params={"bug-numbers": "all"})
+        self.harness.charm._on_apply_patch_action(action_event)
+        mock_mongo_upgrade().apply_patches.assert_called_with("all", **mongo_options())
+
+    @patch("charm.MongoUpgrade")
+    def test_apply_patches_fail(self, mock_mongo_upgrade):
+        self.harness.update_config({"mongodb-uri": "foo"})
+        action_event = Mock(params={"bug-numbers": "1837,latest"})
+        self.harness.charm._on_apply_patch_action(action_event)
+        self.assertEqual(
+            action_event.fail.call_args,
+            [("Failed Patch Application: invalid bug numbers 1837,latest.",)],
+        )
+        action_event = Mock(params={})
+        self.harness.charm._on_apply_patch_action(action_event)
+        self.assertEqual(
+            action_event.fail.call_args,
+            [("Failed Patch Application: bug-number or bug-numbers must be set",)],
+        )
+        mock_mongo_upgrade().apply_patches.assert_not_called()
+
+    @patch("charm.MongoUpgrade")
+    def test_mongo_settings(self, mock_mongo_upgrade):
+        self.harness.update_config(
+            {
+                "mongodb-uri": "foo",
+                "batch-size": 50,
+                "concurrency": 2,
+                "pool-size": 10,
+                "compressors": "zlib",
+                "write-concern": "majority",
+                "max-write-rate": 500,
+                "max-write-latency": 100,
+            }
+        )
+        self.harness.charm.mongo
+        mock_mongo_upgrade.assert_called_once_with(
+            "foo",
+            batch_size=50,
+            concurrency=2,
+            pool_size=10,
+            compressors="zlib",
+            read_concern="",
+            write_concern="majority",
+            max_write_rate=500,
+            max_write_bytes_rate=0,
+            max_write_latency=100,
+            write_buffer_size=16 * 1024 * 1024,
+        )
 
     @patch("charm.MongoUpgrade")
     def test_apply_patch_fail(self, mock_mongo_upgrade):
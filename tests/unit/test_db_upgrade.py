@@ -2,33 +2,1022 @@
 # See LICENSE file for licensing details.
 
 import logging
+import pickle
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, Mock, call, patch
 
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+from pymongo.errors import ExecutionTimeout
+
 import db_upgrade
 from db_upgrade import (
+    _MISSING,
+    ASYNC_ENGINE,
+    CLIENT_MODE,
+    DEFAULT_WRITE_BUFFER_SIZE,
+    RAW_DOCUMENTS,
+    SERVER_MODE,
+    SYNC_ENGINE,
+    BulkWriter,
+    Checkpoint,
+    Ledger,
+    Metrics,
+    Migration,
     MongoPatch1837,
     MongoUpgrade,
     MongoUpgrade910,
     MongoUpgrade1012,
     MysqlUpgrade,
+    Progress,
+    Step,
+    Throttle,
+    UpgradeContext,
+    _count_candidates,
+    _diff,
+    _migrate,
+    _run_migrations,
+    _run_steps,
+    _update,
 )
 
 logger = logging.getLogger(__name__)
 
 
+def raw(document):
+    return RawBSONDocument(bson.encode(document), RAW_DOCUMENTS)
+
+
+class MockCursor(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def cursor_options(batch_size=1000):
+    return {"sort": [("_id", 1)], "batch_size": batch_size, "no_cursor_timeout": True}
+
+
+def mock_collection():
+    collection = Mock()
+    # Documents set as a list in find.return_value are returned in a MockCursor.
+    collection.find.side_effect = lambda *args, **kwargs: (
+        MockCursor(collection.find.return_value)
+        if isinstance(collection.find.return_value, list)
+        else collection.find.return_value
+    )
+    collection.with_options.return_value = collection
+    collection.bulk_write.side_effect = lambda operations, ordered: Mock(
+        matched_count=len(operations), modified_count=len(operations)
+    )
+    collection.update_many.return_value = Mock(matched_count=1, modified_count=1)
+    return collection
+
+
+def mock_client(osm_db):
+    client = MagicMock()
+    client.__getitem__.return_value = osm_db
+    return client
+
+
+class TestUpgradeContext(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("db_upgrade.MongoClient")
+        self.mock_mongo_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_db = MagicMock()
+        self.mock_db.client.server_info.return_value = {"versionArray": [4, 2, 1, 0]}
+        self.mock_mongo_client.return_value = mock_client(self.mock_db)
+
+    def test_collection_names_are_cached(self):
+        self.mock_db.list_collection_names.return_value = ["nsrs", "vnfrs"]
+        context = UpgradeContext("mongo_uri")
+        self.assertTrue(context.has_collection("nsrs"))
+        self.assertFalse(context.has_collection("alarms"))
+        self.mock_db.list_collection_names.assert_called_once()
+
+    def test_server_side(self):
+        self.assertTrue(UpgradeContext("mongo_uri").server_side(pipeline=True))
+        self.assertFalse(UpgradeContext("mongo_uri", mode=CLIENT_MODE).server_side())
+        self.mock_db.client.server_info.return_value = {"versionArray": [4, 0, 28, 0]}
+        context = UpgradeContext("mongo_uri")
+        self.assertFalse(context.server_side(pipeline=True))
+        self.assertFalse(context.server_side(pipeline=True))
+        self.assertTrue(context.server_side())
+        self.assertEqual(self.mock_db.client.server_info.call_count, 2)
+
+    def test_throttled_is_client_side(self):
+        context = UpgradeContext("mongo_uri", partitions=2, max_write_rate=100)
+        self.assertFalse(context.server_side())
+        self.assertEqual(context.throttle.concurrency, 8)
+        self.assertEqual(context.throttle.max_documents, 100)
+        context = UpgradeContext("mongo_uri", mode=SERVER_MODE, max_write_latency=200)
+        self.assertTrue(context.server_side())
+        self.assertEqual(context.throttle.latency_threshold, 0.2)
+        self.assertIsNone(UpgradeContext("mongo_uri").throttle)
+
+    def test_dry_run_is_client_side(self):
+        context = UpgradeContext("mongo_uri", mode=SERVER_MODE, dry_run=True)
+        self.assertFalse(context.server_side())
+        context.add_result("nsrs", {"candidates": 1})
+        self.assertEqual(context.results, {"nsrs": {"candidates": 1}})
+
+    def test_closed_on_exit(self):
+        with UpgradeContext("mongo_uri", maxPoolSize=10):
+            pass
+        self.mock_mongo_client.assert_called_once_with("mongo_uri", maxPoolSize=10)
+        self.mock_mongo_client().close.assert_called_once()
+
+    @patch("db_upgrade.ProcessPoolExecutor")
+    def test_worker_pool(self, mock_pool):
+        with UpgradeContext("mongo_uri", workers=3) as context:
+            self.assertEqual(context.pool, mock_pool.return_value)
+        mock_pool.assert_called_once()
+        self.assertEqual(mock_pool.call_args.kwargs["max_workers"], 3)
+        self.assertEqual(mock_pool.call_args.kwargs["mp_context"].get_start_method(), "forkserver")
+        mock_pool.return_value.shutdown.assert_called_once()
+        self.assertIsNone(context.pool)
+        with UpgradeContext("mongo_uri") as context:
+            self.assertIsNone(context.pool)
+        mock_pool.assert_called_once()
+
+    def test_invalid_mode(self):
+        with self.assertRaises(Exception) as context:
+            UpgradeContext("mongo_uri", mode="fast")
+        self.assertEqual("invalid execution mode fast.", str(context.exception))
+        self.mock_mongo_client.assert_not_called()
+
+    def test_invalid_engine(self):
+        with self.assertRaises(Exception) as context:
+            UpgradeContext("mongo_uri", engine="motor")
+        self.assertEqual("invalid engine motor.", str(context.exception))
+        with self.assertRaises(Exception) as context:
+            UpgradeContext("mongo_uri", engine=ASYNC_ENGINE, workers=2)
+        self.assertEqual(
+            "workers are not supported by the asyncio engine.", str(context.exception)
+        )
+        self.mock_mongo_client.assert_not_called()
+
+
+class TestThrottle(unittest.TestCase):
+    @patch("db_upgrade.time")
+    def test_rate(self, mock_time):
+        mock_time.monotonic.return_value = 0
+        throttle = Throttle(100, 4, max_documents=50, max_bytes=1000)
+        with throttle.write(100, 500):
+            pass
+        mock_time.sleep.assert_called_once_with(2)
+        with throttle.write(10, 2500):
+            pass
+        mock_time.sleep.assert_called_with(3)
+
+    @patch("db_upgrade.time")
+    def test_rate_burst(self, mock_time):
+        mock_time.monotonic.return_value = 0
+        throttle = Throttle(100, 4, max_documents=100)
+        # Nothing is written for 3 seconds, but only 1 second of the rate is saved up.
+        mock_time.monotonic.return_value = 3
+        with throttle.write(100, 0):
+            pass
+        mock_time.sleep.assert_not_called()
+        with throttle.write(100, 0):
+            pass
+        mock_time.sleep.assert_called_once_with(1)
+        with throttle.write(150, 0):
+            pass
+        mock_time.sleep.assert_called_with(2.5)
+
+    def test_rate_after_idle(self):
+        throttle = Throttle(100, 4, max_documents=100)
+        time.sleep(0.3)
+        start = time.monotonic()
+        for _ in range(6):
+            with throttle.write(10, 0):
+                pass
+        # 0.3 seconds of the rate, 30 documents, can be written at once.
+        self.assertGreater(time.monotonic() - start, 0.25)
+
+    def test_latency(self):
+        throttle = Throttle(100, 4, latency_threshold=0.1)
+        for _ in range(4):
+            throttle._adapt(0.5)
+        self.assertEqual((throttle.batch_size, throttle.concurrency), (100, 4))
+        throttle._adapt(0.5)
+        self.assertEqual((throttle.batch_size, throttle.concurrency), (50, 2))
+        for _ in range(5):
+            throttle._adapt(0.2)
+        self.assertEqual((throttle.batch_size, throttle.concurrency), (25, 1))
+        for _ in range(5):
+            throttle._adapt(0.01)
+        self.assertEqual((throttle.batch_size, throttle.concurrency), (35, 2))
+        for _ in range(50):
+            throttle._adapt(0.01)
+        self.assertEqual((throttle.batch_size, throttle.concurrency), (100, 4))
+
+    def test_concurrency(self):
+        throttle = Throttle(100, 1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def write():
+            with throttle.write(1, 0):
+                started.set()
+                release.wait()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        started.wait()
+        second = threading.Thread(target=lambda: throttle.write(1, 0).__enter__())
+        second.start()
+        second.join(0.1)
+        self.assertTrue(second.is_alive())
+        release.set()
+        thread.join()
+        second.join()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_as_dict(self):
+        metrics = Metrics("9-10-alarms", "alarms")
+        metrics.seconds = 1.23456
+        metrics.scanned = 3
+        for latency in range(1, 21):
+            metrics.write(1, latency % 2, 10, latency / 100)
+        self.assertEqual(
+            metrics.as_dict(),
+            {
+                "collection": "alarms",
+                "execution": "client",
+                "seconds": 1.235,
+                "scanned": 3,
+                "matched": 20,
+                "modified": 10,
+                "bytes-read": 0,
+                "bytes-written": 200,
+                "batches": 20,
+                "write-latency": {"p50": 0.1, "p95": 0.19, "p99": 0.2},
+            },
+        )
+
+    def test_no_writes(self):
+        self.assertEqual(
+            Metrics("a", "nsrs").as_dict()["write-latency"], {"p50": 0, "p95": 0, "p99": 0}
+        )
+
+
+class TestProgress(unittest.TestCase):
+    @patch("db_upgrade.time")
+    def test_message(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        progress = Progress(Mock())
+        self.assertIsNone(progress.message())
+        vnfrs, nsrs = Metrics("10-12-vnfrs", "vnfrs"), Metrics("10-12-nsrs", "nsrs")
+        progress.add(vnfrs, 1000)
+        progress.add(nsrs, 0)
+        mock_time.monotonic.return_value = 110
+        vnfrs.documents_read = 250
+        self.assertEqual(
+            progress.message(),
+            "10-12-vnfrs 25% (250/1000), 25 docs/s, ETA 0:00:30; 10-12-nsrs 100% (0/0), 0 docs/s",
+        )
+        progress.remove(nsrs)
+        progress.remove(vnfrs)
+        self.assertIsNone(progress.message())
+
+    def test_report(self):
+        report = Mock()
+        progress = Progress(report, interval=0.01)
+        progress.start()
+        progress.add(Metrics("9-10-alarms", "alarms"), 10)
+        for _ in range(100):
+            if report.called:
+                break
+            time.sleep(0.01)
+        progress.stop()
+        self.assertTrue(report.call_args.args[0].startswith("9-10-alarms 0% (0/10)"))
+
+    def test_count_candidates(self):
+        collection = mock_collection()
+        collection.count_documents.return_value = 5
+        self.assertEqual(_count_candidates(collection, {"a": 1}), 5)
+        collection.count_documents.assert_called_once_with({"a": 1}, maxTimeMS=5000)
+        collection.count_documents.side_effect = ExecutionTimeout("timeout")
+        collection.estimated_document_count.return_value = 50
+        self.assertEqual(_count_candidates(collection, {"a": 1}), 50)
+
+
+class TestBulkWriter(unittest.TestCase):
+    def setUp(self):
+        self.collection = mock_collection()
+
+    def test_flush_when_batch_is_full(self):
+        writer = BulkWriter(self.collection, batch_size=2)
+        writer.update_one({"_id": "1"}, {"$set": {"a": 1}})
+        self.collection.bulk_write.assert_not_called()
+        writer.update_one({"_id": "2"}, {"$set": {"a": 2}})
+        self.collection.bulk_write.assert_called_once_with(
+            [
+                UpdateOne({"_id": "1"}, {"$set": {"a": 1}}),
+                UpdateOne({"_id": "2"}, {"$set": {"a": 2}}),
+            ],
+            ordered=False,
+        )
+
+    def test_throttled_batch_size(self):
+        throttle = Throttle(batch_size=10, concurrency=1, max_bytes=1000)
+        throttle.batch_size = 2
+        with BulkWriter(self.collection, batch_size=10, throttle=throttle) as writer:
+            for i in range(3):
+                writer.update_one({"_id": str(i)}, {"$set": {"a": i}})
+        self.assertEqual(writer.batches, [(2, 2), (1, 1)])
+        self.assertEqual(throttle.documents, 3)
+        self.assertEqual(throttle.bytes, 3 * len(bson.encode({"$set": {"a": 0}})))
+
+    def test_flush_when_buffer_is_full(self):
+        update_size = len(bson.encode({"$set": {"a": 0}}))
+        with BulkWriter(self.collection, batch_size=10, buffer_size=2 * update_size) as writer:
+            for i in range(5):
+                writer.update_one({"_id": str(i)}, {"$set": {"a": i}})
+        self.assertEqual(writer.batches, [(2, 2), (2, 2), (1, 1)])
+
+    def test_invalid_buffer_size(self):
+        with self.assertRaises(Exception) as context:
+            BulkWriter(self.collection, buffer_size=0)
+        self.assertEqual("invalid write buffer size 0.", str(context.exception))
+
+    def test_flush_remaining_operations_on_exit(self):
+        with BulkWriter(self.collection, batch_size=2) as writer:
+            for i in range(3):
+                writer.update_one({"_id": str(i)}, {"$set": {"a": i}})
+        self.assertEqual(self.collection.bulk_write.call_count, 2)
+        self.assertEqual(writer.batches, [(2, 2), (1, 1)])
+        self.assertEqual(writer.matched_count, 3)
+        self.assertEqual(writer.modified_count, 3)
+
+    def test_no_flush_without_operations(self):
+        with BulkWriter(self.collection) as writer:
+            pass
+        self.collection.bulk_write.assert_not_called()
+        self.assertEqual(writer.modified_count, 0)
+
+    def test_no_flush_on_exception(self):
+        with self.assertRaises(ValueError):
+            with BulkWriter(self.collection) as writer:
+                writer.update_one({"_id": "1"}, {"$set": {"a": 1}})
+                raise ValueError()
+        self.collection.bulk_write.assert_not_called()
+
+    def test_update_covered_by_projection(self):
+        with BulkWriter(self.collection, projection={"vdur": 1, "_admin.deployed": 1}) as writer:
+            writer.update_one({"_id": "1"}, {"$set": {"vdur.0.name": "a", "_admin.deployed": {}}})
+        self.collection.bulk_write.assert_called_once()
+
+    def test_update_not_covered_by_projection(self):
+        self.collection.name = "vnfrs"
+        writer = BulkWriter(self.collection, projection={"vdur.vim_info": 1, "_admin.deployed": 1})
+        for field in ("vdur", "_admin", "_admin.deployed_at"):
+            with self.assertRaises(Exception) as context:
+                writer.update_one({"_id": "1"}, {"$set": {field: {}}})
+            self.assertEqual(
+                f"update of {field} in vnfrs is not covered by the projection.",
+                str(context.exception),
+            )
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(Exception) as context:
+            BulkWriter(self.collection, batch_size=0)
+        self.assertEqual("invalid batch size 0.", str(context.exception))
+
+
+class TestDiff(unittest.TestCase):
+    def diff(self, old, new):
+        update = {}
+        _diff(old, new, "field", update)
+        return update
+
+    def test_equal_values(self):
+        self.assertEqual(self.diff({"a": [1, {"b": 2}]}, {"a": [1, {"b": 2}]}), {})
+
+    def test_nested_fields(self):
+        old = {"a": {"b": 1, "c": 2}, "d": [{"e": 1}, {"e": 2}]}
+        new = {"a": {"b": 1, "f": 3}, "d": [{"e": 1}, {"e": 3}]}
+        self.assertEqual(
+            self.diff(old, new),
+            {"$set": {"field.a.f": 3, "field.d.1.e": 3}, "$unset": {"field.a.c": ""}},
+        )
+
+    def test_list_length_changed(self):
+        self.assertEqual(self.diff([1, 2], [1, 2, 3]), {"$set": {"field": [1, 2, 3]}})
+
+    def test_type_changed(self):
+        self.assertEqual(self.diff({"a": 1}, {"a": True}), {"$set": {"field.a": True}})
+        self.assertEqual(self.diff({"a": [1]}, {"a": "[1]"}), {"$set": {"field.a": "[1]"}})
+
+    def test_keys_not_valid_in_paths(self):
+        self.assertEqual(
+            self.diff({"a.b": 1, "c": 1}, {"a.b": 2, "c": 1}),
+            {"$set": {"field": {"a.b": 2, "c": 1}}},
+        )
+
+    def test_missing_fields(self):
+        self.assertEqual(self.diff(_MISSING, 1), {"$set": {"field": 1}})
+        self.assertEqual(self.diff(1, _MISSING), {"$unset": {"field": ""}})
+        self.assertEqual(self.diff(_MISSING, _MISSING), {})
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.collection = mock_collection()
+
+    @staticmethod
+    def transform(document):
+        document["a"]["b"] = 1
+        document.pop("c", None)
+        return document
+
+    def test_only_changed_documents_are_written(self):
+        document = {"_id": "1", "a": {"b": 0}, "c": 2}
+        self.collection.find.return_value = [document, {"_id": "2", "a": {"b": 1}}]
+        scanned, modified = _migrate(
+            self.collection, {"a.b": 0}, {"a.b": 1, "c": 1}, self.transform
+        )
+        self.assertEqual((scanned, modified), (2, 1))
+        self.assertEqual(document, {"_id": "1", "a": {"b": 0}, "c": 2})
+        self.collection.find.assert_called_once_with(
+            {"a.b": 0}, {"a.b": 1, "c": 1}, **cursor_options()
+        )
+        self.collection.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "1"}, {"$set": {"a.b": 1}, "$unset": {"c": ""}})], ordered=False
+        )
+
+    def test_no_writes_if_nothing_changed(self):
+        self.collection.find.return_value = [{"_id": "1", "a": {"b": 1}}]
+        scanned, modified = _migrate(self.collection, {}, {"a.b": 1, "c": 1}, self.transform)
+        self.assertEqual((scanned, modified), (1, 0))
+        self.collection.bulk_write.assert_not_called()
+
+    def test_raw_documents(self):
+        self.collection.find.return_value = [raw({"_id": "1", "a": {"b": 0}, "c": 2})]
+        scanned, modified = _migrate(self.collection, {}, {"a.b": 1, "c": 1}, self.transform)
+        self.assertEqual((scanned, modified), (1, 1))
+        self.collection.with_options.assert_called_once_with(codec_options=RAW_DOCUMENTS)
+        self.collection.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "1"}, {"$set": {"a.b": 1}, "$unset": {"c": ""}})], ordered=False
+        )
+
+    def test_needs_update(self):
+        transform = Mock(side_effect=self.transform)
+        self.collection.find.return_value = [
+            raw({"_id": "1", "a": {"b": 0}, "skip": True}),
+            raw({"_id": "2", "a": {"b": 0}, "skip": False}),
+        ]
+        scanned, modified = _migrate(
+            self.collection,
+            {},
+            {"a.b": 1, "skip": 1},
+            transform,
+            needs_update=lambda document: not document["skip"],
+        )
+        self.assertEqual((scanned, modified), (2, 1))
+        transform.assert_called_once()
+        self.assertEqual(transform.call_args.args[0]["_id"], "2")
+        self.collection.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "2"}, {"$set": {"a.b": 1}})], ordered=False
+        )
+
+    def test_partitions(self):
+        self.collection.aggregate.return_value = [{"_id": str(i)} for i in range(9, -1, -1)]
+        self.collection.find.side_effect = lambda query, projection, **options: MockCursor(
+            [
+                {"_id": "1", "a": {"b": 0}},
+                {"_id": "2", "a": {"b": 1}},
+            ]
+        )
+        scanned, modified = _migrate(
+            self.collection, {"a.b": 0}, {"a.b": 1}, self.transform, partitions=3
+        )
+        self.assertEqual((scanned, modified), (6, 3))
+        self.assertEqual(self.collection.bulk_write.call_count, 3)
+        queries = sorted((call.args[0] for call in self.collection.find.call_args_list), key=str)
+        self.assertEqual(
+            queries,
+            sorted(
+                [
+                    {"$and": [{"a.b": 0}, {"_id": {"$lt": "3"}}]},
+                    {"$and": [{"a.b": 0}, {"_id": {"$gte": "3", "$lt": "6"}}]},
+                    {"$and": [{"a.b": 0}, {"_id": {"$gte": "6"}}]},
+                ],
+                key=str,
+            ),
+        )
+
+    def test_partitions_of_mixed_ids(self):
+        self.collection.aggregate.return_value = [{"_id": "1"}, {"_id": 2}]
+        self.collection.find.return_value = []
+        _migrate(self.collection, {"a.b": 0}, {"a.b": 1}, self.transform, partitions=2)
+        self.collection.find.assert_called_once_with({"a.b": 0}, {"a.b": 1}, **cursor_options())
+
+    def test_checkpoints(self):
+        checkpoint = Mock(ranges=[])
+        self.collection.find.return_value = [{"_id": str(i), "a": {"b": 0}} for i in range(5)]
+        _migrate(self.collection, {}, {"a.b": 1}, self.transform, 2, checkpoint=checkpoint)
+        checkpoint.start.assert_called_once_with(
+            [{"lower": None, "upper": None, "last": None, "scanned": 0, "modified": 0}]
+        )
+        self.assertEqual(
+            checkpoint.update.call_args_list, [call(0, "1", 2, 2), call(0, "3", 4, 4)]
+        )
+        self.assertEqual(self.collection.bulk_write.call_count, 3)
+        self.collection.find.assert_called_once_with({}, {"a.b": 1}, **cursor_options(2))
+
+    def test_metrics(self):
+        metrics = Metrics("a", "nsrs")
+        documents = [raw({"_id": str(i), "a": {"b": i % 2}}) for i in range(3)]
+        self.collection.find.return_value = documents
+        _migrate(self.collection, {}, {"a.b": 1}, self.transform, 1, metrics=metrics)
+        self.assertEqual(metrics.bytes_read, sum(len(document.raw) for document in documents))
+        self.assertEqual(metrics.bytes_written, 2 * len(bson.encode({"$set": {"a.b": 1}})))
+        self.assertEqual((metrics.batches, metrics.matched), (2, 2))
+        self.assertEqual(len(metrics.latencies), 2)
+
+    def test_cursor_closed_on_failure(self):
+        cursor = MockCursor([{"_id": "1", "a": {}}])
+        self.collection.find.side_effect = lambda *args, **kwargs: cursor
+        with self.assertRaises(KeyError):
+            _migrate(self.collection, {}, {"a.b": 1}, lambda document: document["b"])
+        self.assertTrue(cursor.closed)
+
+    def test_resume_from_checkpoint(self):
+        id_range = {"lower": None, "upper": "8", "last": "4", "scanned": 4, "modified": 1}
+        checkpoint = Mock(ranges=[id_range])
+        self.collection.find.return_value = [{"_id": "5", "a": {"b": 0}}]
+        scanned, modified = _migrate(
+            self.collection, {"a.b": 0}, {"a.b": 1}, self.transform, checkpoint=checkpoint
+        )
+        self.assertEqual((scanned, modified), (5, 2))
+        checkpoint.start.assert_not_called()
+        self.collection.find.assert_called_once_with(
+            {"$and": [{"a.b": 0}, {"_id": {"$gt": "4", "$lt": "8"}}]},
+            {"a.b": 1},
+            **cursor_options(),
+        )
+
+    def test_workers(self):
+        checkpoint = Mock(ranges=[])
+        kdur = [{"additionalParams": {"a": 1}}]
+        self.collection.find.return_value = [
+            raw({"_id": str(i), "kdur": kdur if i % 2 else []}) for i in range(5)
+        ]
+        scanned, modified = _migrate(
+            self.collection,
+            {},
+            {"kdur": 1},
+            MongoPatch1837._transform_vnfr,
+            2,
+            checkpoint=checkpoint,
+            needs_update=MongoPatch1837._vnfr_needs_update,
+            workers=2,
+        )
+        self.assertEqual((scanned, modified), (5, 2))
+        self.assertEqual(
+            checkpoint.update.call_args_list, [call(0, "1", 2, 1), call(0, "3", 4, 2)]
+        )
+        self.assertEqual(
+            self.collection.bulk_write.call_args_list,
+            [
+                call(
+                    [
+                        UpdateOne(
+                            {"_id": str(i)}, {"$set": {"kdur.0.additionalParams": '{"a": 1}'}}
+                        )
+                    ],
+                    ordered=False,
+                )
+                for i in (1, 3)
+            ],
+        )
+
+    def test_workers_shared_pool(self):
+        self.collection.find.return_value = [raw({"_id": "1", "kdur": [{"additionalParams": 1}]})]
+        with patch("db_upgrade.ProcessPoolExecutor") as mock_pool, ThreadPoolExecutor(1) as pool:
+            scanned, modified = _migrate(
+                self.collection,
+                {},
+                {"kdur": 1},
+                MongoPatch1837._transform_vnfr,
+                workers=2,
+                pool=pool,
+            )
+        mock_pool.assert_not_called()
+        self.assertEqual((scanned, modified), (1, 1))
+
+    def test_workers_errors(self):
+        self.collection.find.return_value = [raw({"_id": "1", "kdur": []})]
+        with self.assertRaises(KeyError):
+            _migrate(
+                self.collection, {}, {"kdur": 1}, MongoUpgrade1012._transform_k8scluster, workers=1
+            )
+
+    def test_asyncio_engine(self):
+        checkpoint = Mock(ranges=[])
+        self.collection.find.return_value = [
+            raw({"_id": str(i), "a": {"b": i % 2}}) for i in range(5)
+        ]
+        scanned, modified = _migrate(
+            self.collection,
+            {},
+            {"a.b": 1},
+            self.transform,
+            2,
+            checkpoint=checkpoint,
+            engine=ASYNC_ENGINE,
+            in_flight_writes=2,
+        )
+        self.assertEqual((scanned, modified), (5, 3))
+        self.assertEqual(
+            checkpoint.update.call_args_list,
+            [call(0, "1", 2, 1), call(0, "3", 4, 2), call(0, "4", 5, 3)],
+        )
+        self.assertEqual(
+            self.collection.bulk_write.call_args_list,
+            [
+                call([UpdateOne({"_id": _id}, {"$set": {"a.b": 1}})], ordered=False)
+                for _id in ("0", "2", "4")
+            ],
+        )
+
+    def test_asyncio_engine_partitions(self):
+        self.collection.aggregate.return_value = [{"_id": str(i)} for i in range(10)]
+        self.collection.find.side_effect = lambda query, projection, **options: MockCursor(
+            [raw({"_id": "1", "a": {"b": 0}}), raw({"_id": "2", "a": {"b": 1}})]
+        )
+        scanned, modified = _migrate(
+            self.collection, {}, {"a.b": 1}, self.transform, partitions=3, engine=ASYNC_ENGINE
+        )
+        self.assertEqual((scanned, modified), (6, 3))
+        self.assertEqual(self.collection.find.call_count, 3)
+
+    def test_asyncio_engine_errors(self):
+        self.collection.find.return_value = [raw({"_id": str(i), "a": {"b": 0}}) for i in range(5)]
+        self.collection.bulk_write.side_effect = Exception("write failed")
+        with self.assertRaises(Exception) as context:
+            _migrate(self.collection, {}, {"a.b": 1}, self.transform, 2, engine=ASYNC_ENGINE)
+        self.assertEqual("write failed", str(context.exception))
+
+    def test_invalid_in_flight_writes(self):
+        with self.assertRaises(Exception) as context:
+            _migrate(self.collection, {}, {"a.b": 1}, self.transform, in_flight_writes=0)
+        self.assertEqual("invalid number of in-flight writes 0.", str(context.exception))
+
+    def test_invalid_workers(self):
+        with self.assertRaises(Exception) as context:
+            _migrate(self.collection, {}, {"a.b": 1}, self.transform, workers=-1)
+        self.assertEqual("invalid number of workers -1.", str(context.exception))
+
+    def test_invalid_partitions(self):
+        with self.assertRaises(Exception) as context:
+            _migrate(self.collection, {}, {"a.b": 1}, self.transform, partitions=0)
+        self.assertEqual("invalid number of partitions 0.", str(context.exception))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.checkpoints = Mock()
+        self.checkpoint = Checkpoint(self.checkpoints, "nsrs+nsrs", "nsrs")
+
+    def test_save_progress(self):
+        id_range = {"lower": None, "upper": None, "last": None, "scanned": 0, "modified": 0}
+        self.checkpoint.start([id_range])
+        self.checkpoint.update(0, "10", 1000, 3)
+        self.assertEqual(self.checkpoints.replace_one.call_count, 2)
+        query, document = self.checkpoints.replace_one.call_args.args
+        self.assertEqual(query, {"_id": "nsrs+nsrs"})
+        self.assertEqual(document["collection"], "nsrs")
+        self.assertEqual(
+            document["ranges"],
+            [{"lower": None, "upper": None, "last": "10", "scanned": 1000, "modified": 3}],
+        )
+        self.assertTrue(self.checkpoints.replace_one.call_args.kwargs["upsert"])
+        self.checkpoint.finish()
+        self.checkpoints.delete_one.assert_called_once_with({"_id": "nsrs+nsrs"})
+
+    def test_load(self):
+        self.checkpoints.find_one.return_value = None
+        self.checkpoint.load()
+        self.assertEqual(self.checkpoint.ranges, [])
+        self.checkpoints.find_one.return_value = {"_id": "nsrs+nsrs", "ranges": ["range"]}
+        self.checkpoint.load()
+        self.assertEqual(self.checkpoint.ranges, ["range"])
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.collection = Mock()
+        self.ledger = Ledger(self.collection)
+        self.migration = Migration("9-10-alarms", "alarms", {}, {"a": 1}, lambda alarm: alarm)
+
+    def test_applied(self):
+        self.collection.find_one.return_value = {
+            "_id": "osm",
+            "version": "10",
+            "migrations": {"9-10-alarms": {"checksum": self.migration.checksum}},
+        }
+        self.assertTrue(self.ledger.applied(self.migration))
+        self.assertEqual(self.ledger.version, "10")
+        changed = Migration("9-10-alarms", "alarms", {}, {"b": 1}, lambda alarm: alarm)
+        self.assertFalse(self.ledger.applied(changed))
+        # Only a new version changes the checksum when the logic of the migration changes.
+        reformatted = Migration("9-10-alarms", "alarms", {}, {"a": 1}, lambda alarm: (alarm))
+        self.assertTrue(self.ledger.applied(reformatted))
+        revised = Migration("9-10-alarms", "alarms", {}, {"a": 1}, lambda a: a, version=2)
+        self.assertFalse(self.ledger.applied(revised))
+        self.collection.find_one.assert_called_once_with({"_id": "osm"})
+
+    def test_empty_ledger(self):
+        self.collection.find_one.return_value = None
+        self.assertFalse(self.ledger.applied(self.migration))
+        self.assertIsNone(self.ledger.version)
+
+    def test_record(self):
+        self.ledger.record(self.migration, 10, 2)
+        query, update = self.collection.update_one.call_args.args
+        self.assertEqual(query, {"_id": "osm"})
+        entry = update["$set"]["migrations.9-10-alarms"]
+        self.assertEqual(
+            (entry["scanned"], entry["modified"], entry["version"], entry["checksum"]),
+            (10, 2, 1, self.migration.checksum),
+        )
+        self.ledger.set_version("12")
+        self.assertEqual(self.collection.update_one.call_args.args[1]["$set"]["version"], "12")
+        self.assertTrue(self.collection.update_one.call_args.kwargs["upsert"])
+
+
+class TestRunSteps(unittest.TestCase):
+    def setUp(self):
+        self.context = Mock(concurrency=4)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def step(self, name, collection, depends_on=(), barrier=None):
+        def function(context):
+            if barrier:
+                barrier.wait(timeout=5)
+            with self.lock:
+                self.calls.append(name)
+
+        return Step(name, collection, function, depends_on)
+
+    def test_disjoint_collections_run_in_parallel(self):
+        barrier = threading.Barrier(2)
+        steps = [
+            self.step("nsrs", "nsrs", barrier=barrier),
+            self.step("vnfrs", "vnfrs", barrier=barrier),
+        ]
+        _run_steps(Mock(concurrency=2), steps)
+        self.assertFalse(barrier.broken)
+        self.assertCountEqual(self.calls, ["nsrs", "vnfrs"])
+
+    def test_same_collection_runs_in_order(self):
+        steps = [self.step(str(i), "vnfrs") for i in range(5)]
+        _run_steps(Mock(concurrency=4), steps)
+        self.assertEqual(self.calls, ["0", "1", "2", "3", "4"])
+
+    def test_dependencies(self):
+        steps = [
+            self.step("vnfrs", "vnfrs", depends_on=["nsrs"]),
+            self.step("nsrs", "nsrs"),
+        ]
+        _run_steps(Mock(concurrency=4), steps)
+        self.assertEqual(self.calls, ["nsrs", "vnfrs"])
+
+    def test_step_failure(self):
+        failing_step = Step("nsrs", "nsrs", Mock(side_effect=Exception("failed")))
+        steps = [failing_step, self.step("vnfrs", "vnfrs", depends_on=["nsrs"])]
+        with self.assertRaises(Exception) as context:
+            _run_steps(self.context, steps)
+        self.assertEqual("failed", str(context.exception))
+        self.assertEqual(self.calls, [])
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(Exception) as context:
+            _run_steps(self.context, [self.step("vnfrs", "vnfrs", depends_on=["nsrs"])])
+        self.assertEqual("step vnfrs depends on unknown step nsrs.", str(context.exception))
+
+    def test_circular_dependency(self):
+        steps = [
+            self.step("vnfrs", "vnfrs", depends_on=["nsrs"]),
+            self.step("nsrs", "nsrs", depends_on=["vnfrs"]),
+        ]
+        with self.assertRaises(Exception) as context:
+            _run_steps(self.context, steps)
+        self.assertEqual(
+            "circular dependency between steps ['vnfrs', 'nsrs'].", str(context.exception)
+        )
+
+    def test_invalid_concurrency(self):
+        with self.assertRaises(Exception) as context:
+            _run_steps(Mock(concurrency=0), [])
+        self.assertEqual("invalid concurrency 0.", str(context.exception))
+
+
+class TestRunMigrations(unittest.TestCase):
+    def setUp(self):
+        self.nsrs = mock_collection()
+        self.context = Mock(
+            concurrency=4,
+            batch_size=1000,
+            partitions=1,
+            dry_run=False,
+            resume=False,
+            workers=0,
+            pool=None,
+            engine=SYNC_ENGINE,
+            in_flight_writes=2,
+            throttle=None,
+            write_buffer_size=DEFAULT_WRITE_BUFFER_SIZE,
+            progress=None,
+        )
+        self.vnfrs = mock_collection()
+        self.vnfrs.find.return_value = []
+        self.context.osm_db = MagicMock()
+        self.context.osm_db.__getitem__.side_effect = {"nsrs": self.nsrs, "vnfrs": self.vnfrs}.get
+        self.context.server_side.return_value = False
+
+    @staticmethod
+    def set_field(field, value):
+        def transform(document):
+            if field not in document:
+                document[field] = value
+            return document
+
+        return transform
+
+    def test_migrations_of_a_collection_are_fused(self):
+        self.nsrs.find.return_value = [{"_id": "1"}, {"_id": "2", "b": 0}]
+        # MongoDB does not modify the documents that already have the values of the update.
+        self.nsrs.bulk_write.side_effect = lambda operations, ordered: Mock(
+            matched_count=len(operations), modified_count=1
+        )
+        migrations = [
+            Migration("a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1)),
+            Migration("vnfrs", "vnfrs", {"c": None}, {"c": 1}, self.set_field("c", 1)),
+            Migration("b", "nsrs", {"b": None}, {"b": 1, "a.x": 1}, self.set_field("b", 2)),
+        ]
+        _run_migrations(self.context, migrations)
+        self.nsrs.find.assert_called_once_with(
+            {"$or": [{"a": None}, {"b": None}]}, {"a": 1, "b": 1}, **cursor_options()
+        )
+        self.nsrs.bulk_write.assert_called_once_with(
+            [
+                UpdateOne({"_id": "1"}, {"$set": {"a": 1, "b": 2}}),
+                UpdateOne({"_id": "2"}, {"$set": {"a": 1}}),
+            ],
+            ordered=False,
+        )
+        results = dict(call.args for call in self.context.add_result.call_args_list)
+        metrics = results["a+b"]
+        self.assertEqual(
+            (metrics["collection"], metrics["scanned"], metrics["modified"], metrics["batches"]),
+            ("nsrs", 2, 1, 1),
+        )
+
+    def test_progress(self):
+        self.context.progress = Mock()
+        self.nsrs.count_documents.return_value = 2
+        self.nsrs.find.return_value = [{"_id": "1"}, {"_id": "2"}]
+        _run_migrations(
+            self.context, [Migration("a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1))]
+        )
+        metrics, total = self.context.progress.add.call_args.args
+        self.assertEqual((metrics.name, metrics.documents_read, total), ("a", 2, 2))
+        self.context.progress.remove.assert_called_once_with(metrics)
+
+    def test_dry_run(self):
+        self.context.dry_run = True
+        self.nsrs.count_documents.return_value = 10
+        self.nsrs.aggregate.return_value = [
+            {"_id": "1"},
+            {"_id": "2", "a": 0},
+            {"_id": "3"},
+            {"_id": "4", "a": 0},
+        ]
+        server_update = Mock()
+        migration = Migration(
+            "a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1), server_update
+        )
+        _run_migrations(self.context, [migration])
+        server_update.assert_not_called()
+        self.nsrs.bulk_write.assert_not_called()
+        self.nsrs.aggregate.assert_called_once_with(
+            [{"$match": {"a": None}}, {"$sample": {"size": 1000}}, {"$project": {"a": 1}}]
+        )
+        result = self.context.add_result.call_args.args[1]
+        self.assertEqual(self.context.add_result.call_args.args[0], "nsrs")
+        self.assertEqual(
+            {key: value for key, value in result.items() if key != "estimated-seconds"},
+            {
+                "candidates": 10,
+                "sampled": 4,
+                "would-modify": 5,
+                "bytes": 5 * len(bson.encode({"$set": {"a": 1}})),
+            },
+        )
+
+    def test_dry_run_seconds(self):
+        clock = [0]
+
+        def sample():
+            # The server samples all the candidates before returning the first document.
+            clock[0] += 100
+            yield {"_id": "1"}
+            clock[0] += 1
+            yield {"_id": "2"}
+
+        self.context.dry_run = True
+        self.nsrs.count_documents.return_value = 10
+        self.nsrs.aggregate.return_value = sample()
+        migration = Migration("a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1))
+        with patch("db_upgrade.time.monotonic", side_effect=lambda: clock[0]):
+            _run_migrations(self.context, [migration])
+        self.assertEqual(self.context.add_result.call_args.args[1]["estimated-seconds"], 5)
+
+    def test_applied_migrations_are_skipped(self):
+        a = Migration("a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1))
+        b = Migration("b", "nsrs", {"b": None}, {"b": 1}, self.set_field("b", 2))
+        c = Migration("c", "nsrs", {"c": None}, {"c": 1}, self.set_field("c", 3))
+        self.context.force = False
+        self.context.ledger.applied.side_effect = lambda migration: migration is b
+        self.nsrs.find.return_value = [{"_id": "1"}]
+        _run_migrations(self.context, [a, b, c])
+        self.nsrs.find.assert_called_once_with(
+            {"$or": [{"a": None}, {"c": None}]}, {"a": 1, "c": 1}, **cursor_options()
+        )
+        self.assertEqual(self.context.ledger.record.call_args_list, [call(a, 1, 1), call(c, 1, 1)])
+        self.context.force = True
+        self.nsrs.find.reset_mock()
+        _run_migrations(self.context, [a, b, c])
+        self.assertEqual(
+            self.nsrs.find.call_args.args[0],
+            {"$or": [{"$or": [{"a": None}, {"b": None}]}, {"c": None}]},
+        )
+
+    def test_resume(self):
+        self.context.resume = True
+        checkpoints = self.context.osm_db.get_collection.return_value
+        checkpoints.find_one.return_value = {
+            "ranges": [{"lower": None, "upper": None, "last": "1", "scanned": 1, "modified": 1}]
+        }
+        self.nsrs.find.return_value = [{"_id": "2"}]
+        migration = Migration("a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1))
+        _run_migrations(self.context, [migration])
+        self.context.osm_db.get_collection.assert_called_once_with("upgrade_checkpoints")
+        checkpoints.find_one.assert_called_once_with({"_id": "a"})
+        self.nsrs.find.assert_called_once_with(
+            {"$and": [{"a": None}, {"_id": {"$gt": "1"}}]}, {"a": 1}, **cursor_options()
+        )
+        checkpoints.delete_one.assert_called_once_with({"_id": "a"})
+
+    def test_fused_migrations_are_picklable(self):
+        first, second = MongoUpgrade1012.migrations()[1], MongoPatch1837.migrations()[1]
+        fused = pickle.loads(pickle.dumps(first.fuse(second)))
+        vnfr = {"vdur": [{"vim_info": {"vim:1": {}}}], "kdur": [{"additionalParams": {}}]}
+        self.assertTrue(fused.needs_update(raw(vnfr)))
+        self.assertEqual(
+            fused.transform(vnfr)["vdur"], [{"vim_info": {"vim:1": {"vim_message": None}}}]
+        )
+
+    def test_server_side_migrations_are_not_fused(self):
+        self.context.server_side.return_value = True
+        server_update = Mock(return_value=(1, 1))
+        migrations = [
+            Migration("a", "nsrs", {"a": None}, {"a": 1}, self.set_field("a", 1), server_update),
+            Migration("b", "nsrs", {"b": None}, {"b": 1}, self.set_field("b", 2)),
+        ]
+        self.nsrs.find.return_value = []
+        _run_migrations(self.context, migrations)
+        server_update.assert_called_once_with(self.nsrs)
+        self.nsrs.find.assert_called_once_with({"b": None}, {"b": 1}, **cursor_options())
+
+
 class TestUpgradeMongo910(unittest.TestCase):
     @patch("db_upgrade.MongoClient")
     def test_upgrade_mongo_9_10(self, mock_mongo_client):
         mock_db = MagicMock()
-        alarms = Mock()
+        alarms = mock_collection()
         alarms.find.return_value = [{"_id": "1", "alarm_status": "1"}]
         collection_dict = {"alarms": alarms, "other": {}}
         mock_db.list_collection_names.return_value = collection_dict
         mock_db.__getitem__.side_effect = collection_dict.__getitem__
-        mock_mongo_client.return_value = {"osm": mock_db}
-        MongoUpgrade910.upgrade("mongo_uri")
-        alarms.update_one.assert_not_called()
+        mock_mongo_client.return_value = mock_client(mock_db)
+        _run_migrations(
+            UpgradeContext("mongo_uri", mode=CLIENT_MODE), MongoUpgrade910.migrations()
+        )
+        alarms.bulk_write.assert_not_called()
 
     @patch("db_upgrade.MongoClient")
     def test_upgrade_mongo_9_10_no_alarms(self, mock_mongo_client):
@@ -37,29 +1026,67 @@ class TestUpgradeMongo910(unittest.TestCase):
 
         mock_db.list_collection_names.return_value = {"other": {}}
         mock_db.alarms.return_value = None
-        mock_mongo_client.return_value = {"osm": mock_db}
-        self.assertIsNone(MongoUpgrade910.upgrade("mongo_uri"))
+        mock_mongo_client.return_value = mock_client(mock_db)
+        self.assertIsNone(
+            _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade910.migrations())
+        )
 
     @patch("db_upgrade.MongoClient")
     def test_upgrade_mongo_9_10_no_alarm_status(self, mock_mongo_client):
         mock_db = MagicMock()
-        alarms = Mock()
+        alarms = mock_collection()
         alarms.find.return_value = [{"_id": "1"}]
         collection_dict = {"alarms": alarms, "other": {}}
         mock_db.list_collection_names.return_value = collection_dict
         mock_db.__getitem__.side_effect = collection_dict.__getitem__
         mock_db.alarms.return_value = alarms
-        mock_mongo_client.return_value = {"osm": mock_db}
-        MongoUpgrade910.upgrade("mongo_uri")
-        alarms.update_one.assert_called_once_with({"_id": "1"}, {"$set": {"alarm_status": "ok"}})
+        mock_mongo_client.return_value = mock_client(mock_db)
+        _run_migrations(
+            UpgradeContext("mongo_uri", mode=CLIENT_MODE), MongoUpgrade910.migrations()
+        )
+        alarms.find.assert_called_once_with(
+            {"alarm_status": {"$in": [None, "", False, 0]}},
+            {"alarm_status": 1},
+            **cursor_options(),
+        )
+        alarms.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "1"}, {"$set": {"alarm_status": "ok"}})], ordered=False
+        )
+
+    @patch("db_upgrade.MongoClient")
+    def test_upgrade_mongo_9_10_server_side(self, mock_mongo_client):
+        mock_db = MagicMock()
+        alarms = mock_collection()
+        collection_dict = {"alarms": alarms, "other": {}}
+        mock_db.list_collection_names.return_value = collection_dict
+        mock_db.__getitem__.side_effect = collection_dict.__getitem__
+        mock_mongo_client.return_value = mock_client(mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade910.migrations())
+        alarms.find.assert_not_called()
+        alarms.update_many.assert_called_once_with(
+            {"alarm_status": {"$in": [None, "", False, 0]}}, {"$set": {"alarm_status": "ok"}}
+        )
+
+    @patch("db_upgrade.MongoClient")
+    def test_upgrade_mongo_9_10_invalid_mode(self, mock_mongo_client):
+        mock_db = MagicMock()
+        collection_dict = {"alarms": mock_collection()}
+        mock_db.list_collection_names.return_value = collection_dict
+        mock_db.__getitem__.side_effect = collection_dict.__getitem__
+        mock_mongo_client.return_value = mock_client(mock_db)
+        with self.assertRaises(Exception) as context:
+            _run_migrations(UpgradeContext("mongo_uri", mode="fast"), MongoUpgrade910.migrations())
+        self.assertEqual("invalid execution mode fast.", str(context.exception))
 
 
 class TestUpgradeMongo1012(unittest.TestCase):
     def setUp(self):
         self.mock_db = MagicMock()
-        self.nsrs = Mock()
-        self.vnfrs = Mock()
-        self.k8s_clusters = Mock()
+        # Pipeline updates are not supported, so auto mode falls back to client-side.
+        self.mock_db.client.server_info.return_value = {"versionArray": [4, 0, 28, 0]}
+        self.nsrs = mock_collection()
+        self.vnfrs = mock_collection()
+        self.k8s_clusters = mock_collection()
 
     @patch("db_upgrade.MongoClient")
     def test_update_nsr_empty_nsrs(self, mock_mongo_client):
@@ -67,137 +1094,150 @@ class TestUpgradeMongo1012(unittest.TestCase):
         collection_list = {"nsrs": self.nsrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
 
     @patch("db_upgrade.MongoClient")
     def test_update_nsr_empty_nsr(self, mock_mongo_client):
-        nsr = MagicMock()
-        nsr_values = {"_id": "2", "_admin": {}}
-        nsr.__getitem__.side_effect = nsr_values.__getitem__
-        nsr.items.return_value = []
-        self.nsrs.find.return_value = [nsr]
+        self.nsrs.find.return_value = [{"_id": "2", "_admin": {}}]
         collection_list = {"nsrs": self.nsrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.nsrs.bulk_write.assert_not_called()
 
     @patch("db_upgrade.MongoClient")
     def test_update_nsr_add_vim_message(self, mock_mongo_client):
-        nsr = MagicMock()
-        vim_info1 = {"vim_info_key1": {}}
-        vim_info2 = {"vim_info_key2": {"vim_message": "Hello"}}
-        nsr_items = {"nsr_item_key": [{"vim_info": vim_info1}, {"vim_info": vim_info2}]}
-        nsr_values = {"_id": "2", "_admin": {}}
-        nsr.__getitem__.side_effect = nsr_values.__getitem__
-        nsr.items.return_value = nsr_items.items()
-        self.nsrs.find.return_value = [nsr]
+        vld = [
+            {"vim_info": {"vim_info_key1": {}}},
+            {"vim_info": {"vim_info_key2": {"vim_message": "Hello"}}},
+            {"name": "no vim_info"},
+        ]
+        self.nsrs.find.return_value = [{"_id": "2", "vld": vld, "_admin": {}}]
+        collection_list = {"nsrs": self.nsrs}
+        self.mock_db.__getitem__.side_effect = collection_list.__getitem__
+        self.mock_db.list_collection_names.return_value = collection_list
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        update = {"$set": {"vld.0.vim_info.vim_info_key1.vim_message": None}}
+        self.nsrs.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "2"}, update)], ordered=False
+        )
+
+    @patch("db_upgrade.MongoClient")
+    def test_update_nsr_add_vim_message_to_images_and_flavors(self, mock_mongo_client):
+        image = [{"vim_info": {"vim:1": {"vim_id": "img"}}}]
+        flavor = [{"vim_info": {"vim:1": {"vim_id": "flv", "vim_message": "Hello"}}}]
+        self.nsrs.find.return_value = [{"_id": "2", "image": image, "flavor": flavor}]
         collection_list = {"nsrs": self.nsrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_vim_info = {"vim_info_key1": {"vim_message": None}}
-        expected_vim_info2 = {"vim_info_key2": {"vim_message": "Hello"}}
-        self.assertEqual(vim_info1, expected_vim_info)
-        self.assertEqual(vim_info2, expected_vim_info2)
-        self.nsrs.update_one.assert_called_once_with({"_id": "2"}, {"$set": nsr_items})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        query, projection = self.nsrs.find.call_args.args
+        self.assertIn({"image.vim_info": {"$exists": True}}, query["$or"])
+        self.assertIn({"flavor.vim_info": {"$exists": True}}, query["$or"])
+        self.assertEqual((projection["image"], projection["flavor"]), (1, 1))
+        update = {"$set": {"image.0.vim_info.vim:1.vim_message": None}}
+        self.nsrs.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "2"}, update)], ordered=False
+        )
 
     @patch("db_upgrade.MongoClient")
     def test_update_nsr_admin(self, mock_mongo_client):
-        nsr = MagicMock()
         k8s = [{"k8scluster-uuid": "namespace"}, {"k8scluster-uuid": "kube-system:k8s"}]
         admin = {"deployed": {"K8s": k8s}}
-        nsr_values = {"_id": "2", "_admin": admin}
-        nsr.__getitem__.side_effect = nsr_values.__getitem__
-        nsr_items = {}
-        nsr.items.return_value = nsr_items.items()
-        self.nsrs.find.return_value = [nsr]
+        self.nsrs.find.return_value = [{"_id": "2", "_admin": admin}]
         collection_list = {"nsrs": self.nsrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_k8s = [{"k8scluster-uuid": "namespace"}, {"k8scluster-uuid": "k8s"}]
-        self.nsrs.update_one.assert_called_once_with(
-            {"_id": "2"}, {"$set": {"_admin.deployed.K8s": expected_k8s}}
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        update = {"$set": {"_admin.deployed.K8s.1.k8scluster-uuid": "k8s"}}
+        self.nsrs.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "2"}, update)], ordered=False
         )
 
+    @patch("db_upgrade.MongoClient")
+    def test_update_nsr_already_upgraded(self, mock_mongo_client):
+        vld = [{"vim_info": {"vim_info_key1": {"vim_message": None}}}]
+        admin = {"deployed": {"K8s": [{"k8scluster-uuid": "k8s"}]}}
+        self.nsrs.find.return_value = [{"_id": "2", "vld": vld, "_admin": admin}]
+        collection_list = {"nsrs": self.nsrs}
+        self.mock_db.__getitem__.side_effect = collection_list.__getitem__
+        self.mock_db.list_collection_names.return_value = collection_list
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.nsrs.bulk_write.assert_not_called()
+
     @patch("db_upgrade.MongoClient")
     def test_update_vnfr_empty_vnfrs(self, mock_mongo_client):
         self.vnfrs.find.return_value = [{"_id": "10", "vdur": []}]
         collection_list = {"vnfrs": self.vnfrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        self.vnfrs.update_one.assert_called_once_with({"_id": "10"}, {"$set": {"vdur": []}})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.vnfrs.bulk_write.assert_not_called()
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfr_no_vim_info(self, mock_mongo_client):
-        vdur = {"other": {}}
-        vnfr = {"_id": "10", "vdur": [vdur]}
+        vnfr = {"_id": "10", "vdur": [{"other": {}}]}
         self.vnfrs.find.return_value = [vnfr]
         collection_list = {"vnfrs": self.vnfrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        self.assertEqual(vdur, {"other": {}})
-        self.vnfrs.update_one.assert_called_once_with({"_id": "10"}, {"$set": {"vdur": [vdur]}})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.vnfrs.find.assert_called_once_with(
+            MongoUpgrade1012.VNFR_QUERY, {"vdur": 1}, **cursor_options()
+        )
+        self.assertEqual(vnfr, {"_id": "10", "vdur": [{"other": {}}]})
+        self.vnfrs.bulk_write.assert_not_called()
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfr_vim_message_not_conditions_matched(self, mock_mongo_client):
-        vim_info = {"vim_message": "HelloWorld"}
-        vim_infos = {"key1": vim_info, "key2": "value2"}
-        vdur = {"vim_info": vim_infos, "other": {}}
-        vnfr = {"_id": "10", "vdur": [vdur]}
+        vim_infos = {"key1": {"vim_message": "HelloWorld"}, "key2": "value2"}
+        vnfr = {"_id": "10", "vdur": [{"vim_info": vim_infos, "other": {}}]}
         self.vnfrs.find.return_value = [vnfr]
         collection_list = {"vnfrs": self.vnfrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_vim_info = {"vim_message": "HelloWorld"}
-        self.assertEqual(vim_info, expected_vim_info)
-        self.vnfrs.update_one.assert_called_once_with({"_id": "10"}, {"$set": {"vdur": [vdur]}})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.vnfrs.bulk_write.assert_not_called()
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfr_vim_message_is_missing(self, mock_mongo_client):
-        vim_info = {"interfaces_backup": "HelloWorld"}
-        vim_infos = {"key1": vim_info, "key2": "value2"}
-        vdur = {"vim_info": vim_infos, "other": {}}
-        vnfr = {"_id": "10", "vdur": [vdur]}
+        vim_infos = {"key1": {"interfaces_backup": "HelloWorld"}, "key2": "value2"}
+        vnfr = {"_id": "10", "vdur": [{"vim_info": vim_infos, "other": {}}]}
         self.vnfrs.find.return_value = [vnfr]
         collection_list = {"vnfrs": self.vnfrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_vim_info = {"vim_message": None, "interfaces_backup": "HelloWorld"}
-        self.assertEqual(vim_info, expected_vim_info)
-        self.vnfrs.update_one.assert_called_once_with({"_id": "10"}, {"$set": {"vdur": [vdur]}})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        update = {"$set": {"vdur.0.vim_info.key1.vim_message": None}}
+        self.vnfrs.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "10"}, update)], ordered=False
+        )
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfr_interfaces_backup_is_updated(self, mock_mongo_client):
         vim_info = {"interfaces": "HelloWorld", "vim_message": "ByeWorld"}
         vim_infos = {"key1": vim_info, "key2": "value2"}
-        vdur = {"vim_info": vim_infos, "other": {}}
-        vnfr = {"_id": "10", "vdur": [vdur]}
+        vnfr = {"_id": "10", "vdur": [{"vim_info": vim_infos, "other": {}}]}
         self.vnfrs.find.return_value = [vnfr]
         collection_list = {"vnfrs": self.vnfrs}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_vim_info = {
-            "interfaces": "HelloWorld",
-            "vim_message": "ByeWorld",
-            "interfaces_backup": "HelloWorld",
-        }
-        self.assertEqual(vim_info, expected_vim_info)
-        self.vnfrs.update_one.assert_called_once_with({"_id": "10"}, {"$set": {"vdur": [vdur]}})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        update = {"$set": {"vdur.0.vim_info.key1.interfaces_backup": "HelloWorld"}}
+        self.vnfrs.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "10"}, update)], ordered=False
+        )
 
     @patch("db_upgrade.MongoClient")
     def test_update_k8scluster_empty_k8scluster(self, mock_mongo_client):
@@ -205,8 +1245,8 @@ class TestUpgradeMongo1012(unittest.TestCase):
         collection_list = {"k8sclusters": self.k8s_clusters}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
 
     @patch("db_upgrade.MongoClient")
     def test_update_k8scluster_replace_namespace_in_helm_chart(self, mock_mongo_client):
@@ -216,12 +1256,21 @@ class TestUpgradeMongo1012(unittest.TestCase):
         collection_list = {"k8sclusters": self.k8s_clusters}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_helm_chart = {"id": "Hello", "other": {}}
-        expected_k8s_cluster = {"_id": "8", "_admin": {"helm-chart": expected_helm_chart}}
-        self.k8s_clusters.update_one.assert_called_once_with(
-            {"_id": "8"}, {"$set": expected_k8s_cluster}
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.k8s_clusters.find.assert_called_once_with(
+            {
+                "$or": [
+                    {"_admin.helm-chart.id": {"$regex": "^kube-system:"}},
+                    {"_admin.helm-chart-v3.id": {"$regex": "^kube-system:"}},
+                ]
+            },
+            {"_admin.helm-chart.id": 1, "_admin.helm-chart-v3.id": 1},
+            **cursor_options(),
+        )
+        self.k8s_clusters.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "8"}, {"$set": {"_admin.helm-chart.id": "Hello"}})],
+            ordered=False,
         )
 
     @patch("db_upgrade.MongoClient")
@@ -232,35 +1281,120 @@ class TestUpgradeMongo1012(unittest.TestCase):
         collection_list = {"k8sclusters": self.k8s_clusters}
         self.mock_db.__getitem__.side_effect = collection_list.__getitem__
         self.mock_db.list_collection_names.return_value = collection_list
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoUpgrade1012.upgrade("mongo_uri")
-        expected_helm_chart_v3 = {"id": "Hello", "other": {}}
-        expected_k8s_cluster = {"_id": "8", "_admin": {"helm-chart-v3": expected_helm_chart_v3}}
-        self.k8s_clusters.update_one.assert_called_once_with(
-            {"_id": "8"}, {"$set": expected_k8s_cluster}
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.k8s_clusters.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "8"}, {"$set": {"_admin.helm-chart-v3.id": "Hello"}})],
+            ordered=False,
+        )
+
+    @patch("db_upgrade.MongoClient")
+    def test_update_vnfr_server_side(self, mock_mongo_client):
+        collection_list = {"vnfrs": self.vnfrs}
+        self.mock_db.__getitem__.side_effect = collection_list.__getitem__
+        self.mock_db.list_collection_names.return_value = collection_list
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(
+            UpgradeContext("mongo_uri", mode=SERVER_MODE), MongoUpgrade1012.migrations()
+        )
+        self.vnfrs.find.assert_not_called()
+        self.vnfrs.update_many.assert_called_once_with(
+            MongoUpgrade1012.VNFR_QUERY, MongoUpgrade1012._vnfr_pipeline()
+        )
+
+    @patch("db_upgrade.MongoClient")
+    def test_update_k8scluster_auto_server_side(self, mock_mongo_client):
+        self.mock_db.client.server_info.return_value = {"versionArray": [4, 2, 0, 0]}
+        collection_list = {"k8sclusters": self.k8s_clusters}
+        self.mock_db.__getitem__.side_effect = collection_list.__getitem__
+        self.mock_db.list_collection_names.return_value = collection_list
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoUpgrade1012.migrations())
+        self.k8s_clusters.find.assert_not_called()
+        # Both charts are updated in a single pass, so each cluster is counted once.
+        self.k8s_clusters.update_many.assert_called_once_with(
+            MongoUpgrade1012.K8SCLUSTER_QUERY, MongoUpgrade1012._k8scluster_pipeline()
+        )
+        (set_stage,) = MongoUpgrade1012._k8scluster_pipeline()
+        admin = set_stage["$set"]["_admin"]["$mergeObjects"]
+        self.assertEqual(admin[0], "$_admin")
+        self.assertEqual(list(admin[1]), ["helm-chart", "helm-chart-v3"])
+        length = {"$subtract": [{"$strLenCP": "$_admin.helm-chart.id"}, 12]}
+        self.assertEqual(
+            admin[1]["helm-chart"]["$cond"][1],
+            {
+                "$mergeObjects": [
+                    "$_admin.helm-chart",
+                    {"id": {"$substrCP": ["$_admin.helm-chart.id", 12, length]}},
+                ]
+            },
+        )
+
+    @patch("db_upgrade.MongoClient")
+    def test_update_k8scluster_client_mode(self, mock_mongo_client):
+        self.mock_db.client.server_info.return_value = {"versionArray": [5, 0, 0, 0]}
+        self.k8s_clusters.find.return_value = []
+        collection_list = {"k8sclusters": self.k8s_clusters}
+        self.mock_db.__getitem__.side_effect = collection_list.__getitem__
+        self.mock_db.list_collection_names.return_value = collection_list
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(
+            UpgradeContext("mongo_uri", mode=CLIENT_MODE), MongoUpgrade1012.migrations()
         )
+        self.k8s_clusters.find.assert_called_once()
+        self.k8s_clusters.update_many.assert_not_called()
+
+    def test_vnfr_needs_update(self):
+        vnfrs = [
+            {"vdur": []},
+            {"vdur": [{"vim_info": {}}]},
+            {"vdur": [{"vim_info": {"vim:1": {}}}]},
+            {"vdur": [{"vim_info": {"vim:1": {"vim_message": None}}}]},
+            {"vdur": [{"vim_info": {"vim:1": {"vim_message": ""}}}]},
+            {"vdur": [{"vim_info": {"vim:1": {"vim_message": "error"}}}]},
+            {"vdur": [{"vim_info": {"vim:1": {"vim_message": None, "interfaces": []}}}]},
+            {
+                "vdur": [
+                    {
+                        "vim_info": {
+                            "vim:1": {
+                                "vim_message": None,
+                                "interfaces": [{"a": 1}],
+                                "interfaces_backup": [{"a": 1}],
+                            }
+                        }
+                    }
+                ]
+            },
+        ]
+        for vnfr in vnfrs:
+            with self.subTest(vnfr=vnfr):
+                self.assertEqual(
+                    MongoUpgrade1012._vnfr_needs_update(raw(vnfr)),
+                    bool(_update(vnfr, {"vdur": 1}, MongoUpgrade1012._transform_vnfr)),
+                )
 
 
 class TestPatch1837(unittest.TestCase):
     def setUp(self):
         self.mock_db = MagicMock()
-        self.vnfrs = Mock()
-        self.nslcmops = Mock()
+        self.vnfrs = mock_collection()
+        self.nslcmops = mock_collection()
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfrs_params_no_vnfrs_or_nslcmops(self, mock_mongo_client):
         collection_dict = {"other": {}}
         self.mock_db.list_collection_names.return_value = collection_dict
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoPatch1837.patch("mongo_uri")
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoPatch1837.migrations())
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfrs_params_no_kdur(self, mock_mongo_client):
         self.vnfrs.find.return_value = {"_id": "1"}
         collection_dict = {"vnfrs": self.vnfrs, "other": {}}
         self.mock_db.list_collection_names.return_value = collection_dict
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoPatch1837.patch("mongo_uri")
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoPatch1837.migrations())
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfrs_params_kdur_without_additional_params(self, mock_mongo_client):
@@ -269,9 +1403,12 @@ class TestPatch1837(unittest.TestCase):
         collection_dict = {"vnfrs": self.vnfrs, "other": {}}
         self.mock_db.list_collection_names.return_value = collection_dict
         self.mock_db.__getitem__.side_effect = collection_dict.__getitem__
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoPatch1837.patch("mongo_uri")
-        self.vnfrs.update_one.assert_called_once_with({"_id": "1"}, {"$set": {"kdur": kdur}})
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoPatch1837.migrations())
+        self.vnfrs.find.assert_called_once_with(
+            MongoPatch1837.VNFRS_QUERY, {"kdur": 1}, **cursor_options()
+        )
+        self.vnfrs.bulk_write.assert_not_called()
 
     @patch("db_upgrade.MongoClient")
     def test_update_vnfrs_params_kdur_two_additional_params(self, mock_mongo_client):
@@ -282,10 +1419,11 @@ class TestPatch1837(unittest.TestCase):
         collection_dict = {"vnfrs": self.vnfrs, "other": {}}
         self.mock_db.list_collection_names.return_value = collection_dict
         self.mock_db.__getitem__.side_effect = collection_dict.__getitem__
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoPatch1837.patch("mongo_uri")
-        self.vnfrs.update_one.assert_called_once_with(
-            {"_id": "1"}, {"$set": {"kdur": [kdur1, {"additionalParams": "4", "other": {}}]}}
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoPatch1837.migrations())
+        self.vnfrs.bulk_write.assert_called_once_with(
+            [UpdateOne({"_id": "1"}, {"$set": {"kdur.1.additionalParams": "4"}})],
+            ordered=False,
         )
 
     @patch("db_upgrade.MongoClient")
@@ -294,12 +1432,12 @@ class TestPatch1837(unittest.TestCase):
         collection_dict = {"nslcmops": self.nslcmops, "other": {}}
         self.mock_db.list_collection_names.return_value = collection_dict
         self.mock_db.__getitem__.side_effect = collection_dict.__getitem__
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoPatch1837.patch("mongo_uri")
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoPatch1837.migrations())
 
     @patch("db_upgrade.MongoClient")
     def test_update_nslcmops_additional_params(self, mock_mongo_client):
-        operation_params_list = {"additionalParamsForVnf": [1, 2, 3]}
+        operation_params_list = {"additionalParamsForVnf": [1, 2, 3], "nsInstanceId": "ns"}
         operation_params_dict = {"primitive_params": {"dict_key": 5}}
         nslcmops1 = {"_id": "1", "other": {}}
         nslcmops2 = {"_id": "2", "operationParams": operation_params_list, "other": {}}
@@ -308,25 +1446,83 @@ class TestPatch1837(unittest.TestCase):
         collection_dict = {"nslcmops": self.nslcmops, "other": {}}
         self.mock_db.list_collection_names.return_value = collection_dict
         self.mock_db.__getitem__.side_effect = collection_dict.__getitem__
-        mock_mongo_client.return_value = {"osm": self.mock_db}
-        MongoPatch1837.patch("mongo_uri")
-        call1 = call(
-            {"_id": "2"}, {"$set": {"operationParams": {"additionalParamsForVnf": "[1, 2, 3]"}}}
+        mock_mongo_client.return_value = mock_client(self.mock_db)
+        _run_migrations(UpgradeContext("mongo_uri"), MongoPatch1837.migrations())
+        self.nslcmops.find.assert_called_once_with(
+            {
+                "$or": [
+                    {"operationParams.additionalParamsForVnf": {"$type": "array"}},
+                    {"operationParams.primitive_params": {"$type": "object"}},
+                ]
+            },
+            {
+                "operationParams.additionalParamsForVnf": 1,
+                "operationParams.primitive_params": 1,
+            },
+            **cursor_options(),
+        )
+        operation1 = UpdateOne(
+            {"_id": "2"}, {"$set": {"operationParams.additionalParamsForVnf": "[1, 2, 3]"}}
         )
-        call2 = call(
-            {"_id": "3"}, {"$set": {"operationParams": {"primitive_params": '{"dict_key": 5}'}}}
+        operation2 = UpdateOne(
+            {"_id": "3"}, {"$set": {"operationParams.primitive_params": '{"dict_key": 5}'}}
         )
-        expected_calls = [call1, call2]
-        self.nslcmops.update_one.assert_has_calls(expected_calls)
+        self.nslcmops.bulk_write.assert_called_once_with([operation1, operation2], ordered=False)
+
+    def test_vnfr_needs_update(self):
+        for kdur, expected in [
+            ([], False),
+            ([{"additionalParams": None}], False),
+            ([{"additionalParams": "{}"}], False),
+            ([{"additionalParams": {}}], False),
+            ([{"additionalParams": "{}"}, {"additionalParams": {"a": 1}}], True),
+        ]:
+            with self.subTest(kdur=kdur):
+                vnfr = {"kdur": kdur}
+                self.assertEqual(MongoPatch1837._vnfr_needs_update(raw(vnfr)), expected)
+                self.assertEqual(
+                    bool(_update(vnfr, {"kdur": 1}, MongoPatch1837._transform_vnfr)), expected
+                )
+
+
+class TestRegistry(unittest.TestCase):
+    def test_registered_migrations(self):
+        self.assertEqual(
+            db_upgrade.MONGODB_UPGRADE_FUNCTIONS,
+            {
+                "9": {"10": [MongoUpgrade910.migrations]},
+                "10": {"12": [MongoUpgrade1012.migrations]},
+            },
+        )
+        self.assertEqual(db_upgrade.BUG_FIXES, {1837: MongoPatch1837.migrations})
+
+    @patch.dict(db_upgrade.BUG_FIXES)
+    def test_register_patch_twice(self):
+        with self.assertRaises(Exception) as context:
+            db_upgrade.register_patch(1837)(Mock())
+        self.assertEqual("bug 1837 already has a patch.", str(context.exception))
+
+    @patch.dict(db_upgrade.MONGODB_UPGRADE_FUNCTIONS)
+    def test_register_upgrade(self):
+        function = db_upgrade.register_upgrade("12", "14")(Mock())
+        self.assertEqual(db_upgrade.MONGODB_UPGRADE_FUNCTIONS["12"], {"14": [function]})
 
 
 class TestMongoUpgrade(unittest.TestCase):
     def setUp(self):
+        patcher = patch("db_upgrade.MongoClient")
+        self.mock_mongo_client = patcher.start()
+        self.addCleanup(patcher.stop)
         self.mongo = MongoUpgrade("http://fake_mongo:27017")
-        self.upgrade_function = Mock()
-        self.patch_function = Mock()
-        db_upgrade.MONGODB_UPGRADE_FUNCTIONS = {"9": {"10": [self.upgrade_function]}}
-        db_upgrade.BUG_FIXES = {1837: self.patch_function}
+        self.upgrade_function = Mock(return_value=[])
+        self.patch_function = Mock(return_value=[])
+        registries = patch.multiple(
+            db_upgrade,
+            MONGODB_UPGRADE_FUNCTIONS={"9": {"10": [self.upgrade_function]}},
+            BUG_FIXES={1837: self.patch_function},
+        )
+        registries.start()
+        self.addCleanup(registries.stop)
 
     def test_validate_upgrade_fail_target(self):
         valid_current = "9"
@@ -347,18 +1543,116 @@ class TestMongoUpgrade(unittest.TestCase):
         valid_target = "10"
         self.assertIsNone(self.mongo._validate_upgrade(valid_current, valid_target))
 
-    @patch("db_upgrade.MongoUpgrade._validate_upgrade")
-    def test_update_mongo_success(self, mock_validate):
+    @patch("db_upgrade._run_migrations")
+    def test_update_mongo_success(self, mock_run_migrations):
         valid_current = "9"
         valid_target = "10"
-        mock_validate.return_value = ""
-        self.mongo.upgrade(valid_current, valid_target)
-        self.upgrade_function.assert_called_once()
+        self.upgrade_function.return_value = ["alarms"]
+        self.mongo.upgrade(valid_current, valid_target, mode=CLIENT_MODE, partitions=2)
+        mock_run_migrations.assert_called_once()
+        context, migrations = mock_run_migrations.call_args.args
+        self.assertEqual(migrations, ["alarms"])
+        self.assertEqual(
+            (context.batch_size, context.mode, context.concurrency, context.partitions),
+            (1000, CLIENT_MODE, 4, 2),
+        )
+        self.mock_mongo_client.assert_called_once_with("http://fake_mongo:27017")
+        self.mock_mongo_client().close.assert_called_once()
+
+    @patch("db_upgrade._run_migrations")
+    def test_update_mongo_multiple_versions(self, mock_run_migrations):
+        db_upgrade.MONGODB_UPGRADE_FUNCTIONS = {
+            "8": {"9": [Mock(return_value=["nsrs-8"])]},
+            "9": {"10": [Mock(return_value=["nsrs-9"])]},
+            "10": {"12": [Mock(return_value=["nsrs-10", "vnfrs-10"])]},
+        }
+        self.mongo.upgrade("9", "12")
+        mock_run_migrations.assert_called_once()
+        self.assertEqual(mock_run_migrations.call_args.args[1], ["nsrs-9", "nsrs-10", "vnfrs-10"])
+        self.mock_mongo_client.assert_called_once()
+
+    def test_upgrade_path(self):
+        db_upgrade.MONGODB_UPGRADE_FUNCTIONS = {
+            "9": {"10": ["9-10"], "11": ["9-11"]},
+            "10": {"12": ["10-12"]},
+            "11": {"12": ["11-12"], "13": ["11-13"]},
+            "12": {"13": ["12-13"]},
+        }
+        self.assertEqual(self.mongo._upgrade_path("9", "13"), ["9-11", "11-13"])
+        self.assertEqual(self.mongo._upgrade_path("10", "13"), ["10-12", "12-13"])
+        with self.assertRaises(Exception) as context:
+            self.mongo._upgrade_path("12", "9")
+        self.assertEqual("cannot upgrade from version 12 to 9.", str(context.exception))
+        with self.assertRaises(Exception):
+            self.mongo._upgrade_path("9", "9")
+
+    @patch("db_upgrade._run_migrations")
+    def test_upgrade_version_in_ledger(self, mock_run_migrations):
+        ledger = self.mock_mongo_client()["osm"].get_collection.return_value
+        ledger.find_one.return_value = {"_id": "osm", "version": "10"}
+        self.assertEqual(self.mongo.current_version(), "10")
+        self.mongo.upgrade("9", "10")
+        ledger.update_one.assert_called_once()
+        self.assertEqual(ledger.update_one.call_args.args[1]["$set"]["version"], "10")
+        self.mongo.upgrade("9", "10", dry_run=True)
+        ledger.update_one.assert_called_once()
 
     def test_validate_apply_patch(self):
         bug_number = 1837
         self.mongo.apply_patch(bug_number)
         self.patch_function.assert_called_once()
+        self.mock_mongo_client().close.assert_called_once()
+
+    def test_client_options(self):
+        mongo = MongoUpgrade(
+            "http://fake_mongo:27017",
+            pool_size=20,
+            compressors="zstd,zlib",
+            read_concern="majority",
+            write_concern="1",
+        )
+        mongo.apply_patch(1837)
+        self.mock_mongo_client.assert_called_once_with(
+            "http://fake_mongo:27017",
+            maxPoolSize=20,
+            compressors="zstd,zlib",
+            readConcernLevel="majority",
+            w=1,
+        )
+
+    @patch("db_upgrade._run_migrations")
+    def test_client_closed_on_failure(self, mock_run_migrations):
+        mock_run_migrations.side_effect = Exception("failed")
+        with self.assertRaises(Exception):
+            self.mongo.apply_patch(1837)
+        self.mock_mongo_client().close.assert_called_once()
+
+    @patch("db_upgrade._run_migrations")
+    def test_apply_patches(self, mock_run_migrations):
+        db_upgrade.BUG_FIXES = {
+            1837: Mock(return_value=["vnfrs-1837"]),
+            57: Mock(return_value=["vnfrs-57", "nsrs-57"]),
+        }
+        self.mongo.apply_patches([1837, 57])
+        mock_run_migrations.assert_called_once()
+        self.assertEqual(
+            mock_run_migrations.call_args.args[1], ["vnfrs-1837", "vnfrs-57", "nsrs-57"]
+        )
+        self.mongo.apply_patches("all")
+        self.assertEqual(
+            mock_run_migrations.call_args.args[1], ["vnfrs-57", "nsrs-57", "vnfrs-1837"]
+        )
+        self.mongo.apply_patches([57, 1837, 57])
+        self.assertEqual(
+            mock_run_migrations.call_args.args[1], ["vnfrs-57", "nsrs-57", "vnfrs-1837"]
+        )
+
+    def test_apply_patches_invalid_bug_fail(self):
+        with self.assertRaises(Exception) as context:
+            self.mongo.apply_patches([1837, 2])
+        self.assertEqual("There is no patch for bug 2", str(context.exception))
+        self.patch_function.assert_not_called()
+        self.mock_mongo_client.assert_not_called()
 
     def test_validate_apply_patch_invalid_bug_fail(self):
         bug_number = 2
@@ -0,0 +1,59 @@
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import pstats
+import sys
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from pathlib import Path
+
+from profiler import TOP_ALLOCATIONS, TOP_FUNCTIONS, profile
+
+
+def migrate_in_thread(documents):
+    return [{"_id": index, "data": "x" * 100} for index in range(documents)]
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name) / "profiles"
+
+    def test_profile(self):
+        with profile("update-db", self.directory) as summary:
+            thread = threading.Thread(target=migrate_in_thread, args=(1000,))
+            thread.start()
+            thread.join()
+        self.assertEqual(
+            set(summary),
+            {
+                "seconds",
+                "peak-memory-bytes",
+                "top-functions",
+                "top-allocations",
+                "profile-file",
+                "memory-file",
+            },
+        )
+        self.assertLessEqual(len(summary["top-functions"]), TOP_FUNCTIONS)
+        self.assertLessEqual(len(summary["top-allocations"]), TOP_ALLOCATIONS)
+        self.assertGreater(summary["peak-memory-bytes"], 100 * 1000)
+        self.assertTrue(summary["profile-file"].startswith(str(self.directory / "update-db-")))
+        # The calls of the threads started in the block are profiled.
+        stats = pstats.Stats(summary["profile-file"])
+        self.assertIn("migrate_in_thread", [function for _, _, function in stats.stats])
+        report = Path(summary["memory-file"]).read_text()
+        self.assertTrue(report.startswith(f"Peak traced memory: {summary['peak-memory-bytes']}"))
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(sys.getprofile())
+
+    def test_profile_exception(self):
+        with self.assertRaises(ValueError):
+            with profile("apply-patch", self.directory) as summary:
+                raise ValueError("failed")
+        self.assertTrue(Path(summary["profile-file"]).exists())
+        self.assertTrue(Path(summary["memory-file"]).exists())
+        self.assertFalse(tracemalloc.is_tracing())